@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import pdb
 import adapy
 import rospy
@@ -13,6 +14,9 @@ from threading import Thread
 from adarrt import AdaRRT
 from std_msgs.msg import Float64MultiArray
 
+from src.assembly_tasks import ComplexTask
+from src.compiled_mdp import load_q_table
+
 import gtts
 import difflib
 import speech_recognition as sr
@@ -86,34 +90,8 @@ def toggleHand(adaHand, displacement):
     adaHand.execute_preshape(displacement)
 
 
-def transition(s_from, a):
-    # preconditions
-    if a in [0, 1] and s_from[a] < 1:
-        p = 1.0
-    elif a == 2 and s_from[a] < 4 and s_from[0] == 1:
-        p = 1.0
-    elif a == 3 and s_from[a] < 1 and s_from[1] == 1:
-        p = 1.0
-    elif a == 4 and s_from[a] < 4 and s_from[a] + 1 <= s_from[a - 2]:
-        p = 1.0
-    elif a == 5 and s_from[a] < 1 and s_from[a] + 1 <= s_from[a - 2]:
-        p = 1.0
-    elif a == 6 and s_from[a] < 4:
-        p = 1.0
-    elif a == 7 and s_from[a] < 1 and s_from[a - 1] == 4:
-        p = 1.0
-    else:
-        p = 0.0
-
-    # transition to next state
-    if p == 1.0:
-        s_to = deepcopy(s_from)
-        s_to[a] += 1
-        s_to[-1] = s_from[-2]
-        s_to[-2] = a
-        return p, s_to
-    else:
-        return p, None
+# transition of the airplane assembly derived from the precondition spec of the task
+transition = ComplexTask.transition
 
 
 def speak(text):
@@ -333,8 +311,13 @@ class AssemblyController:
         # -------------------------------------- Assembly and Aniticipation Info ----------------------------------------- #
 
         # load the learned q_values for each state
-        self.qf = pickle.load(open("q_values.p", "rb"))
-        self.states = pickle.load(open("states.p", "rb"))
+        if os.path.exists("q_values.qtable"):
+            self.qf = load_q_table("q_values.qtable")
+            self.states = self.qf.states
+        else:
+            self.qf = pickle.load(open("q_values.p", "rb"))
+            self.states = pickle.load(open("states.p", "rb"))
+        self.state_idx = {tuple(s): idx for idx, s in enumerate(self.states)}
 
         # actions in airplane assembly and objects required for each action
         self.remaining_user_actions = [0, 1, 2, 3, 4, 5, 6, 7]
@@ -457,8 +440,8 @@ class AssemblyController:
         max_action_val = -np.inf
         available_actions, anticipated_actions = [], []
         
+        s_idx = self.state_idx[tuple(current_state)]
         for a in self.remaining_user_actions:
-            s_idx = self.states.index(current_state)
             p, next_state = transition(current_state, a)
             
             # check if the action results in a new state
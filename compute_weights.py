@@ -1,8 +1,11 @@
 # import python libraries
 import os
 import pdb
+import time
+import argparse
 import numpy as np
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import pickle
 import dill
@@ -12,18 +15,14 @@ import src.optimizer as O  # stochastic gradient descent optimizer
 from src.vi import value_iteration
 from src.maxent_irl import *
 from src.assembly_tasks import *
+from src.compiled_mdp import save_mdp, save_q_table
 from src.import_qualtrics import get_qualtrics_survey
 
 # ----------------------------------------------- Load data ---------------------------------------------------- #
 
-# download data from qualtrics
 learning_survey_id = "SV_8eoX63z06ZhVZRA"
 data_path = "/home/icaros/ros_ws/src/ada_manipulation_demos/data/"  # os.path.dirname(__file__) + "/data/"
-get_qualtrics_survey(dir_save_survey=data_path, survey_id=learning_survey_id)
-
-# load user data
-demo_path = data_path + "Human-Robot Assembly - Learning.csv"
-df = pd.read_csv(demo_path)
+survey_file = "Human-Robot Assembly - Learning.csv"
 
 
 # pre-process feature value
@@ -51,105 +50,204 @@ def load_features(data, user_idx, feature_idx, action_idx):
     return fea_mat
 
 
-# ----------------------------------------------- Optimization -------------------------------------------------- #
+# --------------------------------------------- User information ------------------------------------------------ #
 
-# choose our parameter initialization strategy:
-# initialize parameters with constant
-init = O.Constant(0.5)
+def load_user(df, user_id):
+    """
+    Demonstrations and feature ratings of a user (first response with the user id) in the survey.
+    """
+    idx = df.index[df['Q1'] == user_id][0]
+    canonical_survey_actions = [0, 3, 1, 4, 2, 5]
+    preferred_order = [df[q][idx] for q in ['Q9_1', 'Q9_2', 'Q9_3', 'Q9_4', 'Q9_5', 'Q9_6']]
+    canonical_demo = [a for _, a in sorted(zip(preferred_order, canonical_survey_actions))]
 
-# choose our optimization strategy:
-# we select exponentiated stochastic gradient descent with linear learning-rate decay
-optim = O.ExpSga(lr=O.linear_decay(lr0=0.5))
+    complex_survey_actions = [0, 4, 1, 5, 6, 7, 2, 3]
+    action_counts = [1, 1, 4, 1, 4, 1, 4, 1]
+    preferred_order = [df[q][idx] for q in ['Q15_1', 'Q15_2', 'Q15_3', 'Q15_4', 'Q15_5', 'Q15_6', 'Q15_7', 'Q15_8']]
+    complex_demo = []
+    for _, a in sorted(zip(preferred_order, complex_survey_actions)):
+        complex_demo += [a]*action_counts[a]
 
-# --------------------------------------------- User information ------------------------------------------------ #
+    # user ratings for features
+    canonical_q, complex_q = ["Q6_", "Q7_"], ["Q13_", "Q14_"]
+    canonical_features = load_features(df, idx, canonical_q, [2, 4, 6, 3, 5, 7])
+    complex_features = load_features(df, idx, complex_q, [3, 8, 15, 16, 4, 9, 10, 11])
 
-rank_features = False
-scale_weights = False
+    return canonical_demo, complex_demo, canonical_features, complex_features
 
-user_id = input("Enter user id: ")
 
-print("=======================")
-print("Calculating preference for user:", user_id)
+def survey_user_ids(df):
+    """
+    Ids of all respondents in the survey, in order of their first response (skipping the Qualtrics header rows).
+    """
+    user_ids = []
+    for user_id in df['Q1'][2:]:
+        if isinstance(user_id, str) and user_id.strip() and user_id not in user_ids:
+            user_ids.append(user_id)
 
-idx = df.index[df['Q1'] == user_id][0]
-canonical_survey_actions = [0, 3, 1, 4, 2, 5]
-preferred_order = [df[q][idx] for q in ['Q9_1', 'Q9_2', 'Q9_3', 'Q9_4', 'Q9_5', 'Q9_6']]
-canonical_demo = [a for _, a in sorted(zip(preferred_order, canonical_survey_actions))]
+    return user_ids
 
-# user ratings for features
-canonical_q, complex_q = ["Q6_", "Q7_"], ["Q13_", "Q14_"] 
-canonical_features = load_features(df, idx, canonical_q, [2, 4, 6, 3, 5, 7])
-complex_features = load_features(df, idx, complex_q, [3, 8, 15, 16, 4, 9, 10, 11])
 
 # ---------------------------------------- Training: Learn weights ---------------------------------------------- #
 
-# initialize canonical task
-C = CanonicalTask(canonical_features)
-C.set_end_state(canonical_demo)
-C.enumerate_states()
-C.set_terminal_idx()
-if rank_features:
-    C.convert_to_rankings()
-
-# demonstrations
-canonical_user_demo = [canonical_demo]
-canonical_trajectories = get_trajectories(C.states, canonical_user_demo, C.transition)
-
-print("Training ...")
-
-# using abstract features
-abstract_features = np.array([C.get_features(state) for state in C.states])
-norm_abstract_features = abstract_features / np.linalg.norm(abstract_features, axis=0)
-canonical_rewards_abstract, canonical_weights_abstract = maxent_irl(C, norm_abstract_features,
-                                                                    canonical_trajectories,
-                                                                    optim, init)
-
-print("Weights have been learned for the canonical task! Fingers X-ed.")
-print("Weights -", canonical_weights_abstract)
-
-# scale weights
-if scale_weights:
-    canonical_weights_abstract /= max(canonical_weights_abstract)
-
-# ----------------------------------------- Testing: Predict complex -------------------------------------------- #
-sample_complex_demo = [1, 3, 5, 0, 2, 2, 2, 2, 4, 4, 4, 4, 6, 6, 6, 6, 7]
-
-complex_survey_actions = [0, 4, 1, 5, 6, 7, 2, 3]
-action_counts = [1, 1, 4, 1, 4, 1, 4, 1]
-preferred_order = [df[q][idx] for q in ['Q15_1', 'Q15_2', 'Q15_3', 'Q15_4', 'Q15_5', 'Q15_6', 'Q15_7', 'Q15_8']]
-complex_demo = []
-for _, a in sorted(zip(preferred_order, complex_survey_actions)):
-    complex_demo += [a]*action_counts[a]
-
-# initialize complex task
-X = ComplexTask(complex_features)
-X.set_end_state(sample_complex_demo)
-X.enumerate_states()
-X.set_terminal_idx()
-if rank_features:
-    X.convert_to_rankings()
-
-# using abstract features
-complex_abstract_features = np.array([X.get_features(state) for state in X.states])
-complex_abstract_features /= np.linalg.norm(complex_abstract_features, axis=0)
-
-# transfer rewards to complex task
-transfer_rewards_abstract = complex_abstract_features.dot(canonical_weights_abstract)
-
-# compute q-values for each state based on learned weights
-qf_transfer, _, _ = value_iteration(X.states, X.actions, X.transition, transfer_rewards_abstract, X.terminal_idx)
-
-# score for predicting the action based on transferred rewards based on abstract features
-# predict_sequence, predict_score = predict_trajectory(qf_transfer, X.states, [complex_demo], X.transition,
-#                                                              sensitivity=0.0, consider_options=False)
-
-print("canonical : ", canonical_demo)
-print("preference: ", complex_demo)
-
-# save_path = data_path + "learned_models/"
-pickle.dump(canonical_weights_abstract, open(data_path + "weights_" + user_id + ".p", "wb"))
-pickle.dump(X, open(data_path + "task_" + user_id + ".p", "wb"))
-pickle.dump(complex_abstract_features, open(data_path + "features_" + user_id + ".p", "wb"))
-pickle.dump(qf_transfer, open(data_path + "q_values_" + user_id + ".p", "wb"))
-pickle.dump(X.states, open(data_path + "states_" + user_id + ".p", "wb"))
-print("Q-values have been saved for user " + user_id + ".")
+def compute_weights(user_id, canonical_demo, complex_demo, canonical_features, complex_features, save_path,
+                    rank_features=False, scale_weights=False, check_finite=False):
+    """
+    Learn the weights of a user in the canonical task, transfer them to the complex task and save the learned
+    weights, task, features and q-values of the user in save_path. With check_finite, a ValueError is raised
+    (and nothing is saved) if the learned weights are not finite.
+
+    Returns:
+        The learned weights.
+    """
+
+    # choose our parameter initialization strategy:
+    # initialize parameters with constant
+    init = O.Constant(0.5)
+
+    # choose our optimization strategy:
+    # we select exponentiated stochastic gradient descent with linear learning-rate decay
+    optim = O.ExpSga(lr=O.linear_decay(lr0=0.5))
+
+    # initialize canonical task
+    C = CanonicalTask(canonical_features)
+    C.set_end_state(canonical_demo)
+    C.enumerate_states()
+    C.set_terminal_idx()
+    if rank_features:
+        C.convert_to_rankings()
+
+    # demonstrations
+    canonical_user_demo = [canonical_demo]
+    canonical_trajectories = get_trajectories(C.states, canonical_user_demo, C.transition)
+
+    print("Training ...")
+
+    # using abstract features
+    abstract_features = C.get_feature_matrix()
+    norm_abstract_features = abstract_features / np.linalg.norm(abstract_features, axis=0)
+    canonical_rewards_abstract, canonical_weights_abstract = maxent_irl(C, norm_abstract_features,
+                                                                        canonical_trajectories,
+                                                                        optim, init)
+
+    print("Weights have been learned for the canonical task! Fingers X-ed.")
+    print("Weights -", canonical_weights_abstract)
+
+    if check_finite and not np.all(np.isfinite(canonical_weights_abstract)):
+        raise ValueError("learned weights are not finite: %s" % canonical_weights_abstract)
+
+    # scale weights
+    if scale_weights:
+        canonical_weights_abstract /= max(canonical_weights_abstract)
+
+    # ----------------------------------------- Testing: Predict complex -------------------------------------------- #
+    sample_complex_demo = [1, 3, 5, 0, 2, 2, 2, 2, 4, 4, 4, 4, 6, 6, 6, 6, 7]
+
+    # initialize complex task
+    X = ComplexTask(complex_features)
+    X.set_end_state(sample_complex_demo)
+    X.enumerate_states()
+    X.set_terminal_idx()
+    if rank_features:
+        X.convert_to_rankings()
+
+    # using abstract features
+    complex_abstract_features = X.get_feature_matrix()
+    complex_abstract_features /= np.linalg.norm(complex_abstract_features, axis=0)
+
+    # transfer rewards to complex task
+    transfer_rewards_abstract = complex_abstract_features.dot(canonical_weights_abstract)
+
+    # compute q-values for each state based on learned weights
+    qf_transfer, _, _ = value_iteration(X.states, X.actions, X.successors, transfer_rewards_abstract, X.terminal_idx,
+                                        method="backward")
+
+    # score for predicting the action based on transferred rewards based on abstract features
+    # predict_sequence, predict_score = predict_trajectory(qf_transfer, X.states, [complex_demo], X.transition,
+    #                                                              sensitivity=0.0, consider_options=False)
+
+    print("canonical : ", canonical_demo)
+    print("preference: ", complex_demo)
+
+    # save_path = data_path + "learned_models/"
+    X.pack_states()
+    pickle.dump(canonical_weights_abstract, open(save_path + "weights_" + user_id + ".p", "wb"))
+    pickle.dump(X, open(save_path + "task_" + user_id + ".p", "wb"))
+    pickle.dump(complex_abstract_features, open(save_path + "features_" + user_id + ".p", "wb"))
+    pickle.dump(qf_transfer, open(save_path + "q_values_" + user_id + ".p", "wb"))
+    pickle.dump(X.states, open(save_path + "states_" + user_id + ".p", "wb"))
+    save_q_table(save_path + "q_values_" + user_id + ".qtable", qf_transfer, X.states, X.actions)
+    save_mdp(save_path + "mdp_" + user_id + ".mdp", X, complex_abstract_features, qf_transfer,
+             metadata={"user_id": user_id, "weights": canonical_weights_abstract.tolist()})
+    print("Q-values have been saved for user " + user_id + ".")
+
+    return canonical_weights_abstract
+
+
+def timed_compute_weights(df, user_id, save_path, **kwargs):
+    # run in the worker processes of the batch mode, so that users with invalid survey data only fail themselves
+    start_time = time.time()
+    canonical_demo, complex_demo, canonical_features, complex_features = load_user(df, user_id)
+    if not (np.all(np.isfinite(canonical_features)) and np.all(np.isfinite(complex_features))):
+        raise ValueError("missing feature ratings")
+
+    weights = compute_weights(user_id, canonical_demo, complex_demo, canonical_features, complex_features,
+                              save_path, check_finite=True, **kwargs)
+    return user_id, weights, time.time() - start_time
+
+
+def compute_all_weights(df, save_path, n_workers=None, **kwargs):
+    """
+    Compute the weights and q-values of all respondents in the survey with a pool of worker processes.
+
+    Returns:
+        Dictionary of learned weights by user id (users that failed are left out).
+    """
+    user_ids = survey_user_ids(df)
+    print("Calculating preferences for %d users: %s" % (len(user_ids), ", ".join(user_ids)))
+
+    start_time = time.time()
+    all_weights = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(timed_compute_weights, df, user_id, save_path, **kwargs): user_id
+                   for user_id in user_ids}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            user_id = futures[future]
+            try:
+                _, weights, user_time = future.result()
+                all_weights[user_id] = weights
+                print("[%d/%d] User %s done in %.2fs" % (n_done, len(user_ids), user_id, user_time))
+            except Exception as e:
+                print("[%d/%d] User %s failed: %r" % (n_done, len(user_ids), user_id, e))
+
+    print("Computed weights for %d of %d users in %.2fs" % (len(all_weights), len(user_ids), time.time() - start_time))
+    return all_weights
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Learn user preferences from the survey and compute q-values.")
+    parser.add_argument("--all", action="store_true", help="compute weights for all users in the survey")
+    parser.add_argument("--user", help="user id (asked for if not given)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes for --all")
+    parser.add_argument("--data-path", default=data_path, help="directory of the survey and the saved files")
+    parser.add_argument("--no-download", action="store_true", help="use the survey file in the data directory")
+    args = parser.parse_args()
+
+    # download data from qualtrics
+    if not args.no_download:
+        get_qualtrics_survey(dir_save_survey=args.data_path, survey_id=learning_survey_id)
+
+    # load user data
+    demo_path = os.path.join(args.data_path, survey_file)
+    df = pd.read_csv(demo_path)
+    save_path = os.path.join(args.data_path, "")
+
+    if args.all:
+        compute_all_weights(df, save_path, args.workers)
+    else:
+        user_id = args.user if args.user else input("Enter user id: ")
+
+        print("=======================")
+        print("Calculating preference for user:", user_id)
+
+        compute_weights(user_id, *load_user(df, user_id), save_path)
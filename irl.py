@@ -3,13 +3,14 @@ from copy import deepcopy
 
 
 def get_trajectories(states, demonstrations, transition_function):
+    state_idx = {tuple(s): idx for idx, s in enumerate(states)}
     trajectories = []
     for demo in demonstrations:
         s = states[0]
         trajectory = []
         for action in demo:
             p, sp = transition_function(s, action)
-            s_idx, sp_idx = states.index(s), states.index(sp)
+            s_idx, sp_idx = state_idx[tuple(s)], state_idx[tuple(sp)]
             trajectory.append((s_idx, action, sp_idx))
             s = sp
         trajectories.append(trajectory)
@@ -19,6 +20,7 @@ def get_trajectories(states, demonstrations, transition_function):
 def rollout_trajectory(qf, states, transition_function, remaining_actions, start_state=0):
 
     s = start_state
+    state_idx = {tuple(s): idx for idx, s in enumerate(states)}
     available_actions = deepcopy(remaining_actions)
     generated_sequence = []
     while len(available_actions) > 0:
@@ -39,7 +41,7 @@ def rollout_trajectory(qf, states, transition_function, remaining_actions, start
         take_action = np.random.choice(candidates)
         generated_sequence.append(take_action)
         p, sp = transition_function(states[s], take_action)
-        s = states.index(sp)
+        s = state_idx[tuple(sp)]
         available_actions.remove(take_action)
 
     return generated_sequence
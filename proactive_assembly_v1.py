@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import pdb
 import sys
 import time
@@ -18,6 +19,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
 import common
+from src.compiled_mdp import load_q_table
 
 
 # set to False if operating real robot
@@ -152,8 +154,13 @@ class AssemblyController(QMainWindow):
         user_id = input("Enter user id: ")
 
         # load the learned q_values for each state
-        self.qf = pickle.load(open("data/q_values_" + user_id + ".p", "rb"))
-        self.states = pickle.load(open("data/states_" + user_id + ".p", "rb"))
+        if os.path.exists("data/q_values_" + user_id + ".qtable"):
+            self.qf = load_q_table("data/q_values_" + user_id + ".qtable")
+            self.states = self.qf.states
+        else:
+            self.qf = pickle.load(open("data/q_values_" + user_id + ".p", "rb"))
+            self.states = pickle.load(open("data/states_" + user_id + ".p", "rb"))
+        self.state_idx = {tuple(s): idx for idx, s in enumerate(self.states)}
 
         # actions in airplane assembly and objects required for each action
         self.remaining_user_actions = [0, 1, 2, 3, 4, 5, 6, 7]
@@ -358,8 +365,8 @@ class AssemblyController(QMainWindow):
         max_action_val = -np.inf
         available_actions, anticipated_actions = [], []
         
+        s_idx = self.state_idx[tuple(current_state)]
         for a in self.remaining_user_actions:
-            s_idx = self.states.index(current_state)
             p, next_state = common.transition(current_state, a)
             
             # check if the action results in a new state
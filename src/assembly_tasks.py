@@ -1,10 +1,25 @@
 import numpy as np
-from copy import deepcopy
+from src.lattice import TrajectoryLattice
+
+
+def index_states(states):
+    """
+    Build a hash map from each state (as a tuple) to its index in the list of states.
+    """
+    return {tuple(s): idx for idx, s in enumerate(states)}
 
 
 class AssemblyTask:
 
-    def __init__(self, features):
+    # Declarative specification of the task preconditions (defined by each task):
+    #   max_counts[a] - number of times action a can be performed
+    #   preconditions[a] = {b: k} - action b must be performed at least k times before action a
+    #   paired_preconditions[a] = [b] - each execution of action a requires its own prior execution of action b
+    max_counts = []
+    preconditions = {}
+    paired_preconditions = {}
+
+    def __init__(self, features, history=2):
 
         self.num_actions, self.num_features = np.shape(features)
         self.actions = np.array(range(self.num_actions))
@@ -12,13 +27,223 @@ class AssemblyTask:
 
         self.min_value, self.max_value = 1.0, 7.0  # rating are on 1-7 Likert scale
 
+        # number of most recent actions kept in the state: 2 for the similarity features (current and previous
+        # action), 1 for the effort features (current action) and 0 if features do not depend on the history
+        self.history = history
+
         # start state of the assembly task (none of the actions have been performed)
-        self.s_start = [0] * self.num_actions + [-1, -1]
+        self.s_start = [0] * self.num_actions + [-1] * self.history
         self.s_end = []
 
         self.states = [self.s_start]
+        self.state_idx = index_states(self.states)  # state registry for O(1) lookup of state indices
         self.terminal_idx = []
 
+        # successor index of each state-action pair (-1 if action is not allowed) and mask of allowed actions
+        self.successors = np.zeros((0, self.num_actions), dtype=np.int32)
+        self.valid_actions = np.zeros((0, self.num_actions), dtype=bool)
+        self.levels = np.zeros(0, dtype=int)  # number of completed actions in each state
+
+        # predecessor index in CSR format: the parents of state sp are pred_states[pred_ptr[sp]:pred_ptr[sp + 1]],
+        # reaching sp by taking the corresponding pred_actions
+        self.pred_ptr = np.zeros(1, dtype=np.int64)
+        self.pred_states = np.zeros(0, dtype=np.int32)
+        self.pred_actions = np.zeros(0, dtype=np.int32)
+
+        # optional packed encoding of the states (see pack_states)
+        self.state_array = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # packed tasks are pickled without the list of states and the tables that can be derived from it
+        if self.state_array is not None:
+            for key in ["states", "state_idx", "successors", "valid_actions", "levels", "pred_ptr", "pred_states",
+                        "pred_actions", "state_codes", "code_order"]:
+                state.pop(key, None)
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # tasks pickled before the history depth and the packed encoding were added
+        if "history" not in state:
+            self.history = 2
+        if "state_array" not in state:
+            self.state_array = None
+        if "states" not in state:
+            self.states = self.state_array.tolist()
+        if self.state_array is not None:
+            self.pack_states()
+
+        # tasks pickled before the state registry was added only carry the list of states
+        if "state_idx" not in state:
+            self.state_idx = index_states(self.states)
+        if "successors" not in state:
+            self.compile_transitions()
+        if "levels" not in state:
+            self.levels = np.array([sum(s[:self.num_actions]) for s in self.states])
+        if "pred_ptr" not in state:
+            self.compile_predecessors()
+
+    def add_state(self, state):
+        key = tuple(state)
+        if key not in self.state_idx:
+            self.state_idx[key] = len(self.states)
+            self.states.append(state)
+
+        return self.state_idx[key]
+
+    def get_state_idx(self, state):
+        return self.state_idx[tuple(state)]
+
+    # ------------------------------------------------ Preconditions ----------------------------------------------- #
+
+    @classmethod
+    def compile_preconditions(cls):
+        """
+        Convert the precondition spec of the task into arrays: maximum counts (n_actions), required counts
+        (n_actions x n_actions) and paired preconditions (n_actions x n_actions), cached on the task class.
+        """
+        if "_precondition_arrays" not in cls.__dict__:
+            n_actions = len(cls.max_counts)
+            required = np.zeros((n_actions, n_actions), dtype=int)
+            for a, required_counts in cls.preconditions.items():
+                for b, k in required_counts.items():
+                    required[a, b] = k
+            paired = np.zeros((n_actions, n_actions), dtype=bool)
+            for a, paired_actions in cls.paired_preconditions.items():
+                paired[a, paired_actions] = True
+            cls._precondition_arrays = (np.array(cls.max_counts), required, paired)
+
+        return cls._precondition_arrays
+
+    @classmethod
+    def transition(cls, s_from, a):
+        n_actions = len(cls.max_counts)
+
+        # preconditions
+        if s_from[a] < cls.max_counts[a] and \
+                all(s_from[b] >= k for b, k in cls.preconditions.get(a, {}).items()) and \
+                all(s_from[a] + 1 <= s_from[b] for b in cls.paired_preconditions.get(a, [])):
+            p = 1.0
+        else:
+            p = 0.0
+
+        # transition to next state (action a becomes the most recent action in the history)
+        if p == 1.0:
+            history = [a] + list(s_from[n_actions:])
+            s_to = list(s_from[:n_actions]) + history[:len(s_from) - n_actions]
+            s_to[a] += 1
+            return p, s_to
+        else:
+            return p, None
+
+    @classmethod
+    def back_transition(cls, s_to, a):
+        # preconditions (undoing action a should not violate the preconditions of actions performed after it)
+        if s_to[a] > 0 and \
+                all(s_to[c] < 1 or s_to[a] - 1 >= required_counts.get(a, 0)
+                    for c, required_counts in cls.preconditions.items()) and \
+                all(s_to[c] <= s_to[a] - 1 for c, paired_actions in cls.paired_preconditions.items()
+                    if a in paired_actions):
+            p = 1.0
+        else:
+            p = 0.0
+
+        # transition to previous state
+        if p == 1.0:
+            s_from = list(s_to)
+            s_from[a] -= 1
+            return p, s_from
+        else:
+            return p, None
+
+    @classmethod
+    def legal_actions(cls, states):
+        """
+        Mask (n_states x n_actions) of the actions whose preconditions are satisfied in each of the given states.
+        """
+        max_counts, required, paired = cls.compile_preconditions()
+        counts = np.asarray(states)[:, :len(max_counts)]
+
+        legal = counts < max_counts
+        legal &= np.all(counts[:, None, :] >= required, axis=2)
+        legal &= np.all(~paired | (counts[:, :, None] < counts[:, None, :]), axis=2)
+
+        return legal
+
+    @classmethod
+    def reversible_actions(cls, states):
+        """
+        Mask (n_states x n_actions) of the actions that can be undone in each of the given states.
+        """
+        max_counts, required, paired = cls.compile_preconditions()
+        counts = np.asarray(states)[:, :len(max_counts)]
+        undone = counts[:, :, None] - 1  # count of action a (axis 1) after undoing it
+
+        # actions c (axis 2) performed after action a should still satisfy their preconditions
+        reversible = counts > 0
+        reversible &= np.all((counts[:, None, :] < 1) | (undone >= required.T), axis=2)
+        reversible &= np.all(~paired.T | (counts[:, None, :] <= undone), axis=2)
+
+        return reversible
+
+    # ------------------------------------------- Packed state encoding -------------------------------------------- #
+
+    def pack_states(self):
+        """
+        Store the enumerated states as one contiguous int8 array and encode each state as a mixed-radix integer.
+        The digits of a code are the action counts followed by the action history shifted by one (so that -1 is 0).
+        """
+        self.state_array = np.array(self.states, dtype=np.int8)
+
+        n_history = self.state_array.shape[1] - self.num_actions
+        max_counts = self.state_array[:, :self.num_actions].max(axis=0)
+        self.radices = np.concatenate([max_counts + 1, [self.num_actions + 1] * n_history]).astype(np.int64)
+        self.offsets = np.array([0] * self.num_actions + [1] * n_history, dtype=np.int64)
+        self.strides = np.concatenate([[1], np.cumprod(self.radices[:-1])]).astype(np.int64)
+
+        self.state_codes = self.encode_states(self.state_array)
+        self.code_order = np.argsort(self.state_codes)
+
+    def encode_states(self, states):
+        return (np.asarray(states, dtype=np.int64) + self.offsets).dot(self.strides)
+
+    def decode_states(self, codes):
+        digits = (np.asarray(codes, dtype=np.int64)[..., None] // self.strides) % self.radices
+        return (digits - self.offsets).astype(np.int8)
+
+    def encode_state(self, state):
+        return int(self.encode_states(state))
+
+    def decode_state(self, code):
+        return self.decode_states(code).tolist()
+
+    def next_codes(self, codes, a):
+        """
+        Codes of the states reached by taking action a in the given states (does not check preconditions).
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        n_history = len(self.radices) - self.num_actions
+
+        # the history is shifted by one and action a becomes the most recent action
+        history = (codes[..., None] // self.strides[self.num_actions:]) % self.radices[self.num_actions:]
+        shifted = np.concatenate([np.full(codes.shape + (1,), a + 1), history], axis=-1)[..., :n_history]
+
+        return codes + self.strides[a] + (shifted - history).dot(self.strides[self.num_actions:])
+
+    def lookup_codes(self, codes):
+        """
+        Indices of the states with the given codes (-1 for codes that do not belong to an enumerated state).
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        sorted_codes = self.state_codes[self.code_order]
+        pos = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+
+        return np.where(sorted_codes[pos] == codes, self.code_order[pos], -1)
+
     def scale_features(self):
         self.features = (np.array(self.features) - self.min_value) / (self.max_value - self.min_value)
 
@@ -32,10 +257,16 @@ class AssemblyTask:
 
     def set_end_state(self, user_demo):
         terminal_state = list(np.bincount(user_demo))
+        if self.history == 0:
+            self.s_end.append(terminal_state)
 
         for curr_a in self.actions:
+            if self.history == 0:
+                break
             _, prev_s = self.back_transition(terminal_state, curr_a)
-            if prev_s:
+            if prev_s and self.history == 1:
+                self.s_end.append(terminal_state + [curr_a])
+            elif prev_s:
                 rem_actions = list(user_demo)
                 rem_actions.remove(curr_a)
                 for prev_a in set(rem_actions):
@@ -44,49 +275,143 @@ class AssemblyTask:
                         self.s_end.append(terminal_state + [curr_a, prev_a])
 
     def enumerate_states(self):
-        prev_states = self.states.copy()
-        while prev_states:
-            next_states = []
-            for state in prev_states:
-                for action in self.actions:
-                    p, next_state = self.transition(state, action)
-                    if next_state and (next_state not in next_states) and (next_state not in self.states):
-                        next_states.append(next_state)
-
-            prev_states = next_states
-            self.states += prev_states
+        """
+        Breadth-first enumeration of the states reachable from the current states. The state registry serves as
+        the visited set, and the successor table and level (number of completed actions) of each state are
+        recorded as the states are expanded.
+        """
+        successors = [[-1] * self.num_actions for _ in self.states]
+        levels = [sum(state[:self.num_actions]) for state in self.states]
+
+        frontier = list(range(len(self.states)))
+        while frontier:
+            next_frontier = []
+            legal = self.legal_actions([self.states[s_idx] for s_idx in frontier])
+            for s_idx, action in zip(*np.nonzero(legal)):
+                s_idx = frontier[s_idx]
+                p, next_state = self.transition(self.states[s_idx], action)
+                key = tuple(next_state)
+                if key not in self.state_idx:
+                    next_frontier.append(self.add_state(next_state))
+                    successors.append([-1] * self.num_actions)
+                    levels.append(levels[s_idx] + 1)
+                successors[s_idx][action] = self.state_idx[key]
+
+            frontier = next_frontier
+
+        self.successors = np.array(successors, dtype=np.int32)
+        self.valid_actions = self.successors >= 0
+        self.levels = np.array(levels)
+        self.compile_predecessors()
+
+    def compile_transitions(self):
+        n_states = len(self.states)
+        legal = self.legal_actions(self.states if self.state_array is None else self.state_array)
+
+        self.successors = -np.ones((n_states, self.num_actions), dtype=np.int32)
+        if self.state_array is not None:
+            # next states of packed tasks are computed directly from their codes
+            for action in self.actions:
+                self.successors[legal[:, action], action] = \
+                    self.lookup_codes(self.next_codes(self.state_codes[legal[:, action]], action))
+        else:
+            for s_idx, action in zip(*np.nonzero(legal)):
+                p, next_state = self.transition(self.states[s_idx], action)
+                self.successors[s_idx, action] = self.state_idx.get(tuple(next_state), -1)
+
+        self.valid_actions = self.successors >= 0
+        self.compile_predecessors()
+
+    def compile_predecessors(self):
+        """
+        Build the predecessor index (reverse adjacency in CSR format) from the successor table.
+        """
+        s_idx, actions = np.nonzero(self.valid_actions)
+        sp_idx = self.successors[s_idx, actions]
+
+        order = np.argsort(sp_idx, kind="stable")
+        self.pred_states = s_idx[order].astype(np.int32)
+        self.pred_actions = actions[order].astype(np.int32)
+        self.pred_ptr = np.concatenate([[0], np.cumsum(np.bincount(sp_idx, minlength=len(self.states)))])
+
+    def get_predecessors(self, sp_idx):
+        """
+        Indices of the parent states of state sp_idx and the actions that lead from them to sp_idx.
+        """
+        start, end = self.pred_ptr[sp_idx], self.pred_ptr[sp_idx + 1]
+        return self.pred_states[start:end], self.pred_actions[start:end]
 
     def enumerate_trajectories(self, demos):
 
         n_demos, n_steps = np.shape(demos)
-        all_traj = [[(-1, -1, 0)]]
-        for t in range(n_steps):
-            all_traj_new = []
-            for traj in all_traj:
-                prev_state = traj[-1][2]
-                for action in self.actions:
-                    p, next_state = self.transition(self.states[prev_state], action)
-                    if next_state:
-                        new_traj = deepcopy(traj)
-                        new_traj.append((prev_state, action, self.states.index(next_state)))
-                        all_traj_new.append(new_traj)
-
-            all_traj = deepcopy(all_traj_new)
-        all_traj = np.array(all_traj)
-
-        return all_traj[:, 1:, :]
+        all_traj = list(self.iter_trajectories(demos))
+        if not all_traj:
+            return np.zeros((0, n_steps, 3), dtype=int)
+
+        return np.concatenate(all_traj)
+
+    def iter_trajectories(self, demos, chunk_size=10000, max_memory=None):
+        """
+        Depth-first generation of all trajectories with as many steps as the demos, yielded in chunks (of at most
+        chunk_size trajectories and max_memory bytes) of shape (n_trajectories, n_steps, 3).
+        """
+        n_demos, n_steps = np.shape(demos)
+        if max_memory is not None:
+            chunk_size = max(1, min(chunk_size, max_memory // (n_steps * 3 * np.dtype(int).itemsize)))
+
+        chunk, n_chunk = np.zeros((chunk_size, n_steps, 3), dtype=int), 0
+
+        # current path and the next action to try at each depth of the search
+        path = np.zeros((n_steps, 3), dtype=int)
+        path_states = np.zeros(n_steps + 1, dtype=int)
+        next_action = np.zeros(n_steps + 1, dtype=int)
+
+        depth = 0
+        while depth >= 0:
+            if depth == n_steps:
+                chunk[n_chunk] = path
+                n_chunk += 1
+                if n_chunk == chunk_size:
+                    yield chunk
+                    chunk, n_chunk = np.zeros((chunk_size, n_steps, 3), dtype=int), 0
+                depth -= 1
+                continue
+
+            s, a = path_states[depth], next_action[depth]
+            while a < self.num_actions and self.successors[s, a] < 0:
+                a += 1
+
+            if a == self.num_actions:
+                next_action[depth] = 0
+                depth -= 1
+            else:
+                next_action[depth] = a + 1
+                path[depth] = s, a, self.successors[s, a]
+                path_states[depth + 1] = self.successors[s, a]
+                depth += 1
+
+        if n_chunk > 0:
+            yield chunk[:n_chunk]
+
+    def get_trajectory_lattice(self, demos):
+        """
+        Lattice of the same trajectories as enumerate_trajectories, without materializing them.
+        """
+        n_demos, n_steps = np.shape(demos)
+        return TrajectoryLattice(self.successors, n_steps, start_state=0)
 
     def set_terminal_idx(self):
-        self.terminal_idx = [self.states.index(s_terminal) for s_terminal in self.s_end]
+        self.terminal_idx = [self.get_state_idx(s_terminal) for s_terminal in self.s_end]
 
     def get_features(self, state, new_feature=False):
 
         # calculate current phase
         terminal_state = self.s_end[-1]
-        max_phase = sum(terminal_state[:-2])
-        phase = sum(state[:-2]) / max_phase
+        max_phase = sum(terminal_state[:self.num_actions])
+        phase = sum(state[:self.num_actions]) / max_phase
 
-        curr_a, prev_a = state[-2], state[-1]
+        # current and previous actions (-1 if not kept in the history of the state)
+        curr_a, prev_a = (list(state[self.num_actions:]) + [-1, -1])[:2]
 
         if curr_a >= 0:
             e_p, e_m = self.features[curr_a]
@@ -118,36 +443,70 @@ class AssemblyTask:
 
         return feature_value
 
+    def get_feature_matrix(self, new_feature=False):
+        """
+        Features of all states at once, same as stacking get_features(state) for each state.
+        """
+        states = np.array(self.states) if self.state_array is None else self.state_array.astype(int)
+        history = np.hstack([states[:, self.num_actions:], -np.ones((len(states), 2), dtype=int)])
+        counts, curr_a, prev_a = states[:, :self.num_actions], history[:, 0], history[:, 1]
+
+        # calculate current phase
+        terminal_state = self.s_end[-1]
+        max_phase = sum(terminal_state[:self.num_actions])
+        phase = counts.sum(axis=1) / max_phase
+
+        # pad with a row (and column) of zeros that is selected by the empty history (-1)
+        action_features = np.vstack([self.features, np.zeros(self.num_features)])
+        e_p, e_m = action_features[curr_a].T
+
+        part_similarity = np.zeros((self.num_actions + 1, self.num_actions + 1))
+        part_similarity[:-1, :-1] = self.part_similarity
+        tool_similarity = np.zeros((self.num_actions + 1, self.num_actions + 1))
+        tool_similarity[:-1, :-1] = self.tool_similarity
+        c_part = part_similarity[prev_a, curr_a]
+        c_tool = tool_similarity[prev_a, curr_a]
+
+        feature_matrix = [phase * e_p, phase * e_m, (1.0 - phase) * e_p, (1.0 - phase) * e_m, c_part, c_tool]
+        if new_feature:
+            s_part = ((curr_a == 0) & (counts[:, 1] == 0)) | ((curr_a == 1) & (counts[:, 0] == 1))
+            feature_matrix.append(s_part.astype(float))
+
+        return np.column_stack(feature_matrix)
+
     def prev_states(self, s_to):
+        # look up the parents of enumerated states in the predecessor index
+        if tuple(s_to) in self.state_idx and len(self.pred_ptr) == len(self.states) + 1:
+            parents, _ = self.get_predecessors(self.get_state_idx(s_to))
+            return [list(self.states[s_idx]) for s_idx in parents]
+
+        counts, history = list(s_to[:self.num_actions]), list(s_to[self.num_actions:])
+
+        # without history, any action that can be undone leads to a previous state
+        if self.history == 0:
+            return [s_from for _, s_from in [self.back_transition(counts, a) for a in self.actions] if s_from]
+
         previous_states = []
 
-        curr_a = s_to[-2]
+        curr_a = history[0]
         if curr_a >= 0:
-            s_from = deepcopy(s_to[:-2])
+            s_from = list(counts)
             s_from[curr_a] -= 1
-            prev_a = s_to[-1]
-
-            previous_state = deepcopy(s_from)
-            previous_state.append(prev_a)
-            if prev_a >= 0:
-                hist_s = deepcopy(s_from)
-                hist_s[prev_a] -= 1
-                hist_actions = [a for a, s in enumerate(hist_s) if s >= 1]
-                if hist_actions:
-                    for hist_a in hist_actions:
-                        prob, s = self.back_transition(hist_s, hist_a)
-                        if s:
-                            prev_s = deepcopy(previous_state)
-                            prev_s.append(hist_a)
-                            previous_states.append(prev_s)
-                else:
-                    hist_a = -1
-                    previous_state.append(hist_a)
-                    previous_states.append(previous_state)
+
+            # the history of the previous state is known except for its oldest action, which is any action that can
+            # be undone after undoing the rest of the history (or none if no action is left)
+            hist_s = list(s_from)
+            for prev_a in history[1:]:
+                if prev_a >= 0:
+                    hist_s[prev_a] -= 1
+
+            if any(prev_a < 0 for prev_a in history[1:]) or not any(hist_s):
+                hist_actions = [-1]
             else:
-                hist_a = -1
-                previous_state.append(hist_a)
-                previous_states.append(previous_state)
+                hist_actions = [a for a in self.actions if self.back_transition(hist_s, a)[1]]
+
+            for hist_a in hist_actions:
+                previous_states.append(s_from + history[1:] + [hist_a])
 
         return previous_states
 
@@ -188,49 +547,11 @@ class CanonicalTask(AssemblyTask):
                        [0, 0, 0, 1, 1, 0],
                        [0, 0, 0, 0, 0, 1]]
 
-    @staticmethod
-    def transition(s_from, a):
-        # preconditions
-        if s_from[a] < 1:
-            if a in [0, 1, 2, 5]:
-                prob = 1.0
-            elif a in [3, 4] and s_from[a - 3] == 1:
-                prob = 1.0
-            else:
-                prob = 0.0
-        else:
-            prob = 0.0
-
-        # transition to next state
-        if prob == 1.0:
-            s_to = deepcopy(s_from)
-            s_to[a] += 1
-            s_to[-1] = s_from[-2]
-            s_to[-2] = a
-            return prob, s_to
-        else:
-            return prob, None
-
-    @staticmethod
-    def back_transition(s_to, a):
-        # preconditions
-        if s_to[a] > 0:
-            if a in [0, 1] and s_to[a + 3] < 1:
-                p = 1.0
-            elif a in [2, 3, 4, 5]:
-                p = 1.0
-            else:
-                p = 0.0
-        else:
-            p = 0.0
-
-        # transition to next state
-        if p == 1.0:
-            s_from = deepcopy(s_to)
-            s_from[a] -= 1
-            return p, s_from
-        else:
-            return p, None
+    # preconditions: number of times each action can be performed and actions that must be performed before it
+    max_counts = [1, 1, 1, 1, 1, 1]
+    preconditions = {3: {0: 1},  # screw long bolt after inserting it
+                     4: {1: 1}}  # screw short bolt after inserting it
+    paired_preconditions = {}
 
 
 # ------------------------------------------------ Complex Task ----------------------------------------------------- #
@@ -276,62 +597,13 @@ class ComplexTask(AssemblyTask):
                        [0, 0, 0, 0, 1, 1, 1, 0],
                        [0, 0, 0, 0, 0, 0, 0, 1]]
 
-    @staticmethod
-    def transition(s_from, a):
-        # preconditions
-        if a in [0, 1] and s_from[a] < 1:
-            p = 1.0
-        elif a == 2 and s_from[a] < 4 and s_from[0] == 1:
-            p = 1.0
-        elif a == 3 and s_from[a] < 1 and s_from[1] == 1:
-            p = 1.0
-        elif a == 4 and s_from[a] < 4 and s_from[a] + 1 <= s_from[a - 2]:
-            p = 1.0
-        elif a == 5 and s_from[a] < 1 and s_from[a] + 1 <= s_from[a - 2]:
-            p = 1.0
-        elif a == 6 and s_from[a] < 4:
-            p = 1.0
-        elif a == 7 and s_from[a] < 1 and s_from[a - 1] == 4:
-            p = 1.0
-        else:
-            p = 0.0
-
-        # transition to next state
-        if p == 1.0:
-            s_to = deepcopy(s_from)
-            s_to[a] += 1
-            s_to[-1] = s_from[-2]
-            s_to[-2] = a
-            return p, s_to
-        else:
-            return p, None
-
-    @staticmethod
-    def back_transition(s_to, a):
-        # preconditions
-        if s_to[a] > 0:
-            if a == 0 and s_to[2] < 1:
-                p = 1.0
-            elif a == 1 and s_to[3] < 1:
-                p = 1.0
-            elif a in [2, 3] and s_to[a] > s_to[a + 2]:
-                p = 1.0
-            elif a in [6] and s_to[a + 1] < 1:
-                p = 1.0
-            elif a in [4, 5, 7]:
-                p = 1.0
-            else:
-                p = 0.0
-        else:
-            p = 0.0
-
-        # transition to next state
-        if p == 1.0:
-            s_from = deepcopy(s_to)
-            s_from[a] -= 1
-            return p, s_from
-        else:
-            return p, None
+    # preconditions: number of times each action can be performed and actions that must be performed before it
+    max_counts = [1, 1, 4, 1, 4, 1, 4, 1]
+    preconditions = {2: {0: 1},  # insert long bolts after inserting main wing
+                     3: {1: 1},  # insert long bolt after inserting tail wing
+                     7: {6: 4}}  # screw propeller base after screwing all propeller blades
+    paired_preconditions = {4: [2],  # each long bolt is screwed into main wing after it is inserted
+                            5: [3]}  # the long bolt is screwed into tail wing after it is inserted
 
     # ----------------------------------------------- Event sequence ------------------------------------------------ #
     # @staticmethod
@@ -0,0 +1,283 @@
+"""
+Single-file format for compiled assembly task MDPs.
+
+A compiled MDP bundles the arrays needed to plan in an assembly task (states,
+successor table, terminal states, state features, Q-values, ...) into one file
+that can be opened with memory mapping, so that controllers start without
+unpickling the task and several processes share one copy of a large task.
+
+File layout:
+    magic (8 bytes) | format version (uint32) | header length (uint32) |
+    JSON header | arrays, each aligned to ALIGNMENT bytes
+
+The JSON header holds the dtype, shape and offset of every array and a
+dictionary of metadata.
+"""
+
+import os
+import sys
+import glob
+import json
+import pickle
+import numpy as np
+
+MAGIC = b"ADAMDP\x00\x00"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(path, arrays, metadata=None):
+    """
+    Write arrays and metadata into a single memory-mappable file.
+
+    Args:
+        path: The file to write.
+        arrays: Dictionary of arrays to store, by name.
+        metadata: Dictionary of JSON-serializable metadata.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # offsets are relative to the start of the data section, which follows the (padded) header
+    offset, entries = 0, {}
+    for name, array in arrays.items():
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({"arrays": entries, "metadata": metadata or {}}).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([FORMAT_VERSION, len(header)], dtype="<u4").tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_bundle(path, mmap=True):
+    """
+    Open a file written by write_bundle.
+
+    Args:
+        path: The file to read.
+        mmap: If True, arrays are read-only memory maps of the file instead of
+            copies loaded into memory.
+
+    Returns:
+        A dictionary of arrays by name and the dictionary of metadata.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a compiled MDP file" % path)
+        version, header_length = np.frombuffer(f.read(8), dtype="<u4")
+        if version != FORMAT_VERSION:
+            raise ValueError("%s has format version %d, expected %d" % (path, version, FORMAT_VERSION))
+        header = json.loads(f.read(int(header_length)).decode())
+
+    data_start = _align(len(MAGIC) + 8 + int(header_length))
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        offset = data_start + entry["offset"]
+        if mmap and np.prod(shape) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+    return arrays, header["metadata"]
+
+
+class CompiledMDP:
+    """
+    Arrays of a compiled assembly task, with the same attribute names as
+    AssemblyTask so that it can stand in for the task when planning.
+
+    Attributes:
+        states: States of the task (n_states x state length).
+        actions: Actions of the task.
+        successors: Next state of each state-action pair (-1 if not allowed).
+        valid_actions: Mask of the allowed actions in each state.
+        terminal_idx: Indices of the terminal states.
+        levels: Number of completed actions in each state.
+        pred_ptr, pred_states, pred_actions: Predecessor index (CSR format).
+        state_features: Features of each state (if saved).
+        q_values: Q-value of each state-action pair (if saved).
+        metadata: Dictionary of metadata saved with the task.
+    """
+    def __init__(self, arrays, metadata):
+        self.states = arrays["states"]
+        self.successors = arrays["successors"]
+        self.valid_actions = self.successors >= 0
+        self.actions = np.arange(self.successors.shape[1])
+        self.terminal_idx = list(arrays["terminal_idx"])
+        self.levels = arrays["levels"]
+        self.pred_ptr = arrays["pred_ptr"]
+        self.pred_states = arrays["pred_states"]
+        self.pred_actions = arrays["pred_actions"]
+        self.state_features = arrays.get("state_features")
+        self.q_values = arrays.get("q_values")
+        self.metadata = metadata
+        self.state_idx = None
+
+    def get_state_idx(self, state):
+        # the state registry is only built when a state is looked up
+        if self.state_idx is None:
+            self.state_idx = {tuple(s): idx for idx, s in enumerate(self.states.tolist())}
+
+        return self.state_idx[tuple(state)]
+
+
+def save_mdp(path, task, state_features=None, q_values=None, metadata=None):
+    """
+    Save an enumerated assembly task as a compiled MDP file.
+
+    Args:
+        path: The file to write.
+        task: The AssemblyTask, after enumerate_states and set_terminal_idx.
+        state_features: Features of each state (n_states x n_features).
+        q_values: Q-values as an array (n_states x n_actions) or as the
+            dictionary returned by value_iteration.
+        metadata: Dictionary of JSON-serializable metadata.
+    """
+    arrays = {"states": np.array(task.states, dtype=np.int8),
+              "successors": task.successors,
+              "terminal_idx": np.array(task.terminal_idx, dtype=np.int32),
+              "levels": np.array(task.levels, dtype=np.int32),
+              "pred_ptr": task.pred_ptr,
+              "pred_states": task.pred_states,
+              "pred_actions": task.pred_actions}
+    if state_features is not None:
+        arrays["state_features"] = np.asarray(state_features, dtype=np.float64)
+    if q_values is not None:
+        arrays["q_values"] = q_table_array(q_values, task.actions)
+
+    task_metadata = {"task": type(task).__name__, "history": getattr(task, "history", 2)}
+    task_metadata.update(metadata or {})
+    write_bundle(path, arrays, task_metadata)
+
+
+def load_mdp(path, mmap=True):
+    """
+    Load a compiled MDP file written by save_mdp.
+
+    Args:
+        path: The file to read.
+        mmap: If True, arrays are memory mapped instead of loaded into memory.
+
+    Returns:
+        A CompiledMDP.
+    """
+    arrays, metadata = read_bundle(path, mmap)
+    return CompiledMDP(arrays, metadata)
+
+
+# ------------------------------------------------- Q-tables ---------------------------------------------------- #
+
+def q_table_array(q_values, actions):
+    """
+    Convert the dict-of-dict Q-values returned by value_iteration (or an array) to a float32 array
+    (n_states x n_actions), with 0 for the actions missing from the dictionary.
+    """
+    if isinstance(q_values, dict):
+        q_values = [[q_values[s].get(a, 0.0) for a in actions] for s in range(len(q_values))]
+
+    return np.asarray(q_values, dtype=np.float32)
+
+
+class QTable:
+    """
+    Read-only view of a saved Q-table, indexed like the dictionaries returned by
+    value_iteration: q_table[s_idx][a] is the Q-value of action a in state s_idx.
+
+    Attributes:
+        q_values: Q-value of each state-action pair (n_states x n_actions).
+        states: States of the task (list of lists), in the order of the rows.
+    """
+    def __init__(self, q_values, states):
+        self.q_values = q_values
+        self.states = states
+        self.state_idx = None
+
+    def __getitem__(self, s_idx):
+        return self.q_values[s_idx]
+
+    def __len__(self):
+        return len(self.q_values)
+
+    def get_state_idx(self, state):
+        if self.state_idx is None:
+            self.state_idx = {tuple(s): idx for idx, s in enumerate(self.states)}
+
+        return self.state_idx[tuple(state)]
+
+
+def save_q_table(path, q_values, states, actions=None):
+    """
+    Save Q-values as a float32 array with the array of states as keys.
+
+    Args:
+        path: The file to write.
+        q_values: Q-values as an array (n_states x n_actions) or as the
+            dictionary returned by value_iteration.
+        states: States of the task, in the order of the Q-values.
+        actions: Actions (columns) of the Q-table, the keys of the Q-values
+            of the first state if None.
+    """
+    if actions is None:
+        actions = sorted(q_values[0].keys()) if isinstance(q_values, dict) else range(np.shape(q_values)[1])
+    arrays = {"q_values": q_table_array(q_values, actions),
+              "states": np.array(states, dtype=np.int8)}
+    write_bundle(path, arrays, {"actions": [int(a) for a in actions]})
+
+
+def load_q_table(path, mmap=True):
+    """
+    Load a Q-table written by save_q_table.
+
+    Args:
+        path: The file to read.
+        mmap: If True, the Q-values are memory mapped instead of loaded into memory.
+
+    Returns:
+        A QTable.
+    """
+    arrays, metadata = read_bundle(path, mmap)
+    return QTable(arrays["q_values"], arrays["states"].tolist())
+
+
+def convert_q_values(q_path, states_path, out_path=None):
+    """
+    Convert a pickled dict-of-dict Q-table and its pickled states to a Q-table file.
+
+    Args:
+        q_path: Pickle of the Q-values (e.g. data/q_values_1.p).
+        states_path: Pickle of the states (e.g. data/states_1.p).
+        out_path: The file to write, q_path with the extension .qtable if None.
+
+    Returns:
+        The path of the written file.
+    """
+    if out_path is None:
+        out_path = os.path.splitext(q_path)[0] + ".qtable"
+    with open(q_path, "rb") as f:
+        q_values = pickle.load(f)
+    with open(states_path, "rb") as f:
+        states = pickle.load(f)
+    save_q_table(out_path, q_values, states)
+
+    return out_path
+
+
+if __name__ == "__main__":
+    # convert all pickled Q-tables in a data directory: python -m src.compiled_mdp [data directory]
+    data_path = sys.argv[1] if len(sys.argv) > 1 else "data"
+    for q_path in sorted(glob.glob(os.path.join(data_path, "q_values*.p"))):
+        states_path = q_path.replace("q_values", "states")
+        if os.path.exists(states_path):
+            print("Converted", q_path, "to", convert_q_values(q_path, states_path))
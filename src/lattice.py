@@ -0,0 +1,207 @@
+"""
+Trajectory lattice over the state graph of an assembly task.
+
+Instead of materializing every trajectory through the task, the lattice stores
+how many trajectories continue from each state for each number of remaining
+steps. Trajectories can then be counted, ranked, iterated in chunks and sampled,
+and sums over all trajectories are computed by dynamic programming.
+
+Trajectories are int arrays of shape (n_steps, 3) holding (state, action,
+next state) for each step, in the same format as
+AssemblyTask.enumerate_trajectories.
+"""
+
+import numpy as np
+
+
+def _logsumexp(x, axis):
+    x_max = np.max(x, axis=axis, keepdims=True)
+    x_max[~np.isfinite(x_max)] = 0.0
+    with np.errstate(divide="ignore"):
+        return np.log(np.sum(np.exp(x - x_max), axis=axis)) + np.squeeze(x_max, axis=axis)
+
+
+class TrajectoryLattice:
+    """
+    Lattice (DAG) of all trajectories with a fixed number of steps from a start state.
+
+    Args:
+        successors: Table (n_states x n_actions) of next state indices, -1 if
+            the action is not allowed in the state.
+        n_steps: The number of actions in each trajectory.
+        start_state: The index of the start state.
+
+    Attributes:
+        n_paths: Number of trajectories (n_steps + 1 x n_states) that can be
+            continued from each state with the given number of remaining steps.
+    """
+    def __init__(self, successors, n_steps, start_state=0):
+        self.successors = np.asarray(successors)
+        self.valid_actions = self.successors >= 0
+        self.n_steps = n_steps
+        self.start_state = start_state
+
+        n_states, _ = self.successors.shape
+        self.n_paths = np.zeros((n_steps + 1, n_states), dtype=np.int64)
+        self.n_paths[0] = 1
+        for r in range(1, n_steps + 1):
+            self.n_paths[r] = np.where(self.valid_actions, self.n_paths[r - 1][self.successors], 0).sum(axis=1)
+
+    def count(self):
+        """
+        Returns:
+            The number of trajectories in the lattice.
+        """
+        return int(self.n_paths[self.n_steps, self.start_state])
+
+    def unrank(self, ranks):
+        """
+        Construct the trajectories with the given ranks, where trajectories are
+        ranked in lexicographic order of their actions.
+
+        Args:
+            ranks: Ranks of the trajectories, between 0 and count() - 1.
+
+        Returns:
+            An array (n_ranks x n_steps x 3) of trajectories.
+        """
+        ranks = np.array(ranks, dtype=np.int64)
+        rows = np.arange(len(ranks))
+        trajectories = np.zeros((len(ranks), self.n_steps, 3), dtype=int)
+
+        s = np.full(len(ranks), self.start_state)
+        for t in range(self.n_steps):
+            # number of trajectories that continue with each action
+            counts = np.where(self.valid_actions[s], self.n_paths[self.n_steps - t - 1][self.successors[s]], 0)
+            cum_counts = np.cumsum(counts, axis=1)
+
+            a = np.argmax(cum_counts > ranks[:, None], axis=1)
+            ranks -= cum_counts[rows, a] - counts[rows, a]
+            sp = self.successors[s, a]
+
+            trajectories[:, t, 0], trajectories[:, t, 1], trajectories[:, t, 2] = s, a, sp
+            s = sp
+
+        return trajectories
+
+    def iter_chunks(self, chunk_size=10000):
+        """
+        Lazily iterate over all trajectories in lexicographic order.
+
+        Args:
+            chunk_size: The maximum number of trajectories in each chunk.
+
+        Returns:
+            A generator of trajectory arrays (chunk_size x n_steps x 3).
+        """
+        n_trajectories = self.count()
+        for start in range(0, n_trajectories, chunk_size):
+            yield self.unrank(np.arange(start, min(start + chunk_size, n_trajectories)))
+
+    def log_partition(self, rewards):
+        """
+        Compute the log of the sum of exp(trajectory reward) over all
+        trajectories, where the reward of a trajectory is the sum of the
+        rewards of its start state and of every state reached.
+
+        Args:
+            rewards: The reward of each state.
+
+        Returns:
+            The log partition of the lattice.
+        """
+        rewards = np.asarray(rewards, dtype=float)
+        return rewards[self.start_state] + self._log_z(rewards)[self.n_steps, self.start_state]
+
+    def state_visitation(self, rewards=None):
+        """
+        Compute the probability of visiting each state at each step when
+        trajectories are drawn with probability proportional to exp(trajectory
+        reward), or uniformly if no rewards are given.
+
+        Args:
+            rewards: The reward of each state.
+
+        Returns:
+            The visitation probabilities (n_steps + 1 x n_states).
+        """
+        p_actions = self._action_probabilities(rewards)
+
+        n_states, _ = self.successors.shape
+        d = np.zeros((self.n_steps + 1, n_states))
+        d[0, self.start_state] = 1.0
+        for t in range(self.n_steps):
+            p = d[t][:, None] * p_actions[self.n_steps - t]
+            np.add.at(d[t + 1], self.successors[self.valid_actions], p[self.valid_actions])
+
+        return d
+
+    def expected_feature_sums(self, state_features, rewards=None):
+        """
+        Expected feature sum of the trajectories (start state and every state
+        reached) under the distribution described in state_visitation.
+        """
+        return self.state_visitation(rewards).sum(axis=0).dot(state_features)
+
+    def sample(self, n_samples, rewards=None):
+        """
+        Sample trajectories uniformly, or with probability proportional to
+        exp(trajectory reward) if rewards are given.
+
+        Args:
+            n_samples: The number of trajectories to sample.
+            rewards: The reward of each state.
+
+        Returns:
+            An array (n_samples x n_steps x 3) of trajectories.
+        """
+        if rewards is None:
+            return self.unrank(np.random.randint(0, self.count(), size=n_samples, dtype=np.int64))
+
+        p_actions = self._action_probabilities(rewards)
+        trajectories = np.zeros((n_samples, self.n_steps, 3), dtype=int)
+
+        s = np.full(n_samples, self.start_state)
+        for t in range(self.n_steps):
+            cum_p = np.cumsum(p_actions[self.n_steps - t][s], axis=1)
+            u = np.random.uniform(size=(n_samples, 1)) * cum_p[:, -1:]
+            a = np.argmax(cum_p > u, axis=1)
+            sp = self.successors[s, a]
+
+            trajectories[:, t, 0], trajectories[:, t, 1], trajectories[:, t, 2] = s, a, sp
+            s = sp
+
+        return trajectories
+
+    @staticmethod
+    def feature_sums(state_features, trajectories):
+        """
+        Feature sum (start state and every state reached) of each trajectory.
+        """
+        trajectories = np.asarray(trajectories)
+        return state_features[trajectories[:, 0, 0]] + state_features[trajectories[:, :, 2]].sum(axis=1)
+
+    def _action_probabilities(self, rewards):
+        # probability (n_steps + 1 x n_states x n_actions) of each action for each number of remaining steps
+        if rewards is None:
+            rewards = np.zeros(len(self.successors))
+        rewards = np.asarray(rewards, dtype=float)
+        log_z = self._log_z(rewards)
+
+        p_actions = np.zeros(self.n_paths.shape + (self.successors.shape[1],))
+        for r in range(1, self.n_steps + 1):
+            q = np.where(self.valid_actions, (rewards + log_z[r - 1])[self.successors], -np.inf)
+            with np.errstate(invalid="ignore"):
+                p_actions[r] = np.nan_to_num(np.exp(q - log_z[r][:, None]))
+
+        return p_actions
+
+    def _log_z(self, rewards):
+        # log partition (n_steps + 1 x n_states) of the trajectories continuing from each state for each number of
+        # remaining steps, excluding the reward of the state itself
+        log_z = np.zeros(self.n_paths.shape)
+        for r in range(1, self.n_steps + 1):
+            q = np.where(self.valid_actions, (rewards + log_z[r - 1])[self.successors], -np.inf)
+            log_z[r] = _logsumexp(q, axis=1)
+
+        return log_z
@@ -1,18 +1,29 @@
+import time
 import numpy as np
-from src.vi import value_iteration
+from src.vi import value_iteration, batched_value_iteration, soft_value_iteration, sparse_soft_value_iteration, \
+    use_sparse, TransitionEdges
 from copy import deepcopy
+from collections.abc import Iterator
 from src.assembly_tasks import *
+from src.lattice import TrajectoryLattice
+
+try:
+    from scipy.optimize import minimize
+except ImportError:
+    # the lbfgs solver of maxent_irl is optional
+    minimize = None
 
 # ------------------------------------------------ IRL functions ---------------------------------------------------- #
 
 def get_trajectories(states, demonstrations, transition_function):
+    state_idx = index_states(states)
     trajectories = []
     for demo in demonstrations:
         s = states[0]
         trajectory = []
         for action in demo:
             p, sp = transition_function(s, action)
-            s_idx, sp_idx = states.index(s), states.index(sp)
+            s_idx, sp_idx = state_idx[tuple(s)], state_idx[tuple(sp)]
             trajectory.append((s_idx, action, sp_idx))
             s = sp
         trajectories.append(trajectory)
@@ -21,78 +32,95 @@ def get_trajectories(states, demonstrations, transition_function):
 
 
 def feature_expectation_from_trajectories(s_features, trajectories):
+    """
+    trajectories can be a list of trajectories or an int array (n_demos x n_steps x 3) of (state, action, next state).
+    """
     n_states, n_features = s_features.shape
+    trajectories = np.asarray(trajectories, dtype=int)
 
-    fe = np.zeros(n_features)
-    for t in trajectories:  # for each trajectory
-        for s_idx, a, sp_idx in t:  # for each state in trajectory
-
-            fe += s_features[sp_idx]  # sum-up features
+    # number of visits of each state over all trajectories
+    visits = np.bincount(trajectories[:, :, 2].ravel(), minlength=n_states)
+    fe = visits.dot(s_features)  # sum-up features
 
     return fe / len(trajectories)  # average over trajectories
 
 
 def initial_probabilities_from_trajectories(states, trajectories):
     n_states = len(states)
-    prob = np.zeros(n_states)
+    trajectories = np.asarray(trajectories, dtype=int)
 
-    for t in trajectories:  # for each trajectory
-        prob[t[0][0]] += 1.0  # increment starting state
+    # count starting states
+    prob = np.bincount(trajectories[:, 0, 0], minlength=n_states).astype(float)
 
     return prob / len(trajectories)  # normalize
 
 
-def compute_expected_svf(task, p_initial, reward, max_iters, eps=1e-5):
+def compute_expected_svf(task, p_initial, reward, max_iters, eps=1e-5, backend="auto"):
+    """
+    backend selects dense arrays or a scipy.sparse matrix of the legal transitions ("dense", "sparse" or "auto",
+    see src.vi.use_sparse).
+
+    p_initial and reward can also be (n_users, n_states) matrices, the expected svf of each row is then returned.
+    """
 
     states, actions, terminal = task.states, task.actions, task.terminal_idx
     n_states, n_actions = len(states), len(actions)
 
+    if use_sparse(task.successors, backend):
+        if np.ndim(reward) > 1:
+            return np.array([compute_expected_svf(task, p, r, max_iters, eps, backend)
+                             for p, r in zip(p_initial, reward)])
+
+        edges = TransitionEdges(task.successors, actions)
+
+        # Backward Pass (probability of each legal transition)
+        _, _, p_edges = sparse_soft_value_iteration(edges, reward, terminal, task.levels)
+        transitions = edges.matrix(p_edges, transpose=True)
+
+        # Forward Pass
+        d = np.asarray(p_initial, dtype=float)
+        svf = d.copy()
+        for t in range(1, max_iters):
+            d = transitions.dot(d)
+            svf += d
+
+        return svf
+
     # Backward Pass
-    # 1. initialize at terminal states
-    zs = np.zeros(n_states)  # zs: state partition function
-    zs[terminal] = 1.0
-
-    # 2. perform backward pass
-    for i in range(2*n_states):
-        za = np.zeros((n_states, n_actions))  # za: action partition function
-        for s_idx in range(n_states):
-            for a in actions:
-                prob, sp = task.transition(states[s_idx], a)
-                if sp:
-                    sp_idx = task.states.index(sp)
-                    if zs[sp_idx] > 0.0:
-                        za[s_idx, a] += np.exp(reward[s_idx]) * zs[sp_idx]
-
-        zs = za.sum(axis=1)
-        zs[terminal] = 1.0
-
-    # 3. compute local action probabilities
-    p_action = za / zs[:, None]
+    # 1.-3. soft value iteration from the terminal states (log partition functions) and local action probabilities,
+    # one backward step per level of the task
+    _, _, p_action = soft_value_iteration(task.successors, reward, terminal, actions, task.levels)
+    p_action = p_action.reshape(-1, n_states, n_actions)
 
     # Forward Pass
     # 4. initialize with starting probability
-    d = np.zeros((n_states, max_iters))  # d: state-visitation frequencies
-    d[:, 0] = p_initial
+    d = np.array(p_initial, dtype=float).reshape(-1, n_states)  # d: state-visitation frequencies at the current step
+    n_users = len(d)
+    svf = d.copy()
 
-    # 5. iterate for N steps
+    # 5. iterate for N steps, scattering the frequencies of the states visited at each step to their next states
+    successors = task.successors[:, actions]
     for t in range(1, max_iters):  # longest trajectory: n_states
-        for sp_idx in range(n_states):
-            parents = task.prev_states(states[sp_idx])
-            if parents:
-                for s in parents:
-                    s_idx = states.index(s)
-                    a = states[sp_idx][-1]
-                    d[sp_idx, t] += d[s_idx, t - 1] * p_action[s_idx, a]
+        users, visited = np.nonzero(d)
+        if len(visited) == 0:
+            break
+        next_states = successors[visited]
+        allowed = next_states >= 0
+        flow = d[users, visited, None] * p_action[users, visited]
+        targets = users[:, None] * n_states + next_states
+        d = np.bincount(targets[allowed], weights=flow[allowed], minlength=n_users * n_states).reshape(n_users, -1)
 
-    # 6. sum-up frequencies
-    return d.sum(axis=1)
+        # 6. sum-up frequencies
+        svf += d
+
+    return svf.reshape(np.shape(reward))
 
 
 def compute_expected_svf_using_rollouts(task, reward, max_iters):
     states, actions, terminal = task.states, task.actions, task.terminal_idx
     n_states, n_actions = len(states), len(actions)
 
-    qf, vf, _ = value_iteration(states, actions, task.transition, reward, terminal)
+    qf, vf, _ = value_iteration(states, actions, task.successors, reward, terminal, method="backward")
     svf = np.zeros(n_states)
     for _ in range(n_states):
         s_idx = 0
@@ -101,8 +129,7 @@ def compute_expected_svf_using_rollouts(task, reward, max_iters):
             max_action_val = -np.inf
             candidates = []
             for a in task.actions:
-                p, sp = task.transition(states[s_idx], a)
-                if sp:
+                if task.valid_actions[s_idx, a]:
                     if qf[s_idx][a] > max_action_val:
                         candidates = [a]
                         max_action_val = qf[s_idx][a]
@@ -113,8 +140,7 @@ def compute_expected_svf_using_rollouts(task, reward, max_iters):
                 print("Error: No candidate actions from state", s_idx)
 
             take_action = np.random.choice(candidates)
-            p, sp = task.transition(states[s_idx], take_action)
-            s_idx = states.index(sp)
+            s_idx = task.successors[s_idx, take_action]
             svf[s_idx] += 1
 
     e_svf = svf/n_states
@@ -122,7 +148,48 @@ def compute_expected_svf_using_rollouts(task, reward, max_iters):
     return e_svf
 
 
-def maxent_irl(task, s_features, trajectories, optim, init, eps=1e-3):
+def maxent_log_likelihood(task, s_features, trajectories, omega):
+    """
+    Exact average log-likelihood of the trajectories under the MaxEnt policy of the task for the weights omega, and
+    its gradient. The reward of a trajectory is the sum of the rewards of the state of each step, the same convention
+    as the soft values of soft_value_iteration (0 at the terminal states).
+    """
+    n_states, n_features = s_features.shape
+    trajectories = np.asarray(trajectories)
+    _, demo_length, _ = trajectories.shape
+
+    # reward and features of the trajectories (state of each step)
+    reward = s_features.dot(omega)
+    e_features = s_features[trajectories[:, :, 0]].sum(axis=1).mean(axis=0)
+    p_initial = initial_probabilities_from_trajectories(task.states, trajectories)
+
+    # log partition function of the trajectories from each start state
+    _, soft_values, _ = soft_value_iteration(task.successors, reward, task.terminal_idx, task.actions, task.levels)
+    log_likelihood = e_features.dot(omega) - p_initial.dot(soft_values)
+
+    e_svf = compute_expected_svf(task, p_initial, reward, demo_length)
+    grad = e_features - s_features.T.dot(e_svf)
+
+    return log_likelihood, grad
+
+
+def maxent_irl(task, s_features, trajectories, optim, init, eps=1e-3, svf_method="exact", solver="sga", l2=0.1,
+               max_iters=None, time_budget=None, return_trace=False):
+    """
+    svf_method is "exact" to compute the expected state visitation frequencies with a forward-backward pass over
+    the task (compute_expected_svf), or "rollouts" to estimate them from greedy rollouts of the current policy.
+
+    solver is "sga" to take steps of optim until the weights change by less than eps, or "lbfgs" to maximize the
+    exact log-likelihood (maxent_log_likelihood) with L-BFGS (requires scipy). The log-likelihood of a single
+    demonstration is often unbounded, so L-BFGS maximizes it with an l2 penalty l2 / 2 * |omega|^2; optim is
+    then not used.
+
+    The optimization also stops after max_iters iterations or time_budget seconds (for L-BFGS, the best weights
+    evaluated within the budget are returned). With return_trace, a trace is returned as third value: a dictionary
+    of arrays with the change of the weights ("delta"), the norm of the gradient ("grad_norm"), the exact
+    log-likelihood ("log_likelihood") and the solve time in seconds ("time") of each iteration (each function
+    evaluation for L-BFGS).
+    """
 
     # states, actions = task.states, task.actions
 
@@ -138,30 +205,144 @@ def maxent_irl(task, s_features, trajectories, optim, init, eps=1e-3):
     # compute starting-state probabilities from trajectories
     p_initial = initial_probabilities_from_trajectories(task.states, trajectories)
 
-    # gradient descent optimization
-    omega = init(n_features)  # initialize our parameters
-    delta = np.inf  # initialize delta for convergence check
+    start_time = time.time()
+    trace = {"delta": [], "grad_norm": [], "log_likelihood": [], "time": []}
+
+    def out_of_budget(n_iters):
+        return ((max_iters is not None and n_iters >= max_iters) or
+                (time_budget is not None and time.time() - start_time >= time_budget))
+
+    if solver == "lbfgs":
+        if minimize is None:
+            raise ImportError("scipy is required for the lbfgs solver")
+
+        omega_old = init(n_features)
+        best = {"value": np.inf, "omega": omega_old.copy()}
+
+        def objective(omega):
+            if time_budget is not None and time.time() - start_time >= time_budget:
+                # out of time: a zero gradient makes L-BFGS stop (max_iters remains the hard cap)
+                return best["value"], np.zeros(n_features)
+
+            iter_start = time.time()
+            log_likelihood, grad = maxent_log_likelihood(task, s_features, trajectories, omega)
+            value = -log_likelihood + l2 / 2 * omega.dot(omega)
+            if return_trace:
+                trace["delta"].append(np.max(np.abs(omega - omega_old)))
+                trace["grad_norm"].append(np.linalg.norm(grad))
+                trace["log_likelihood"].append(log_likelihood)
+                trace["time"].append(time.time() - iter_start)
+            omega_old[:] = omega
+            if value < best["value"]:
+                best["value"], best["omega"] = value, omega.copy()
+            return value, -grad + l2 * omega
+
+        options = {} if max_iters is None else {"maxiter": max_iters}
+        omega = minimize(objective, omega_old.copy(), jac=True, method="L-BFGS-B", tol=eps, options=options).x
+        if time_budget is not None and time.time() - start_time >= time_budget:
+            omega = best["omega"]
+    elif solver == "sga":
+        # gradient descent optimization
+        omega = init(n_features)  # initialize our parameters
+        delta = np.inf  # initialize delta for convergence check
+
+        optim.reset(omega)  # re-start optimizer
+        n_iters = 0
+        while delta > eps and not out_of_budget(n_iters):  # iterate until convergence or out of budget
+            iter_start = time.time()
+            omega_old = omega.copy()
+
+            # compute per-state reward from features
+            reward = s_features.dot(omega)
+
+            # compute gradient of the log-likelihood
+            if svf_method == "exact":
+                # start state and the state reached by each action, as in the rollouts
+                e_svf = compute_expected_svf(task, p_initial, reward, demo_length + 1)
+            elif svf_method == "rollouts":
+                e_svf = compute_expected_svf_using_rollouts(task, reward, demo_length)
+            else:
+                raise ValueError("Unknown svf method: %s" % svf_method)
+            grad = e_features - s_features.T.dot(e_svf)
+
+            # perform optimization step and compute delta for convergence
+            optim.step(grad)
+
+            # re-compute delta for convergence check
+            delta = np.max(np.abs(omega_old - omega))
+            # print(delta)
+            n_iters += 1
+
+            if return_trace:
+                trace["time"].append(time.time() - iter_start)
+                trace["delta"].append(delta)
+                trace["grad_norm"].append(np.linalg.norm(grad))
+                trace["log_likelihood"].append(maxent_log_likelihood(task, s_features, trajectories, omega_old)[0])
+    else:
+        raise ValueError("Unknown solver: %s" % solver)
+
+    # re-compute per-state reward and return
+    if return_trace:
+        return s_features.dot(omega), omega, {key: np.array(values) for key, values in trace.items()}
+
+    return s_features.dot(omega), omega
 
-    optim.reset(omega)  # re-start optimizer
-    while delta > eps:  # iterate until convergence
-        omega_old = omega.copy()
 
-        # compute per-state reward from features
-        reward = s_features.dot(omega)
+def maxent_irl_batch(task, s_features, trajectories, optim, init, eps=1e-3, max_iters=None, time_budget=None):
+    """
+    Learn the weights of several users of the same task at once (exponentiated gradient ascent with exact expected
+    svf, as maxent_irl), with the policies of all users solved together in every iteration.
+
+    Args:
+        task: The task shared by all users.
+        s_features: Features of each state for each user (n_users x n_states x n_features).
+        trajectories: The demonstrated trajectories of each user.
+        optim: Optimizer, copied for each user.
+        init: Initializer of the weights.
+        eps: Each user stops when its weights change by less than eps.
+        max_iters: Maximum number of iterations.
+        time_budget: Maximum time (in seconds).
+
+    Returns:
+        Rewards of each state (n_users x n_states) and weights (n_users x n_features) of each user.
+    """
+    s_features = np.asarray(s_features)
+    n_users, n_states, n_features = s_features.shape
+    demo_length = max(np.shape(user_trajectories)[1] for user_trajectories in trajectories)
+
+    # feature expectations and starting-state probabilities of each user
+    e_features = np.array([feature_expectation_from_trajectories(f, t) for f, t in zip(s_features, trajectories)])
+    p_initial = np.array([initial_probabilities_from_trajectories(task.states, t) for t in trajectories])
+
+    # one optimizer for each user, updating the user's row of the weights in place
+    omega = np.array([init(n_features) for _ in range(n_users)])
+    optims = [deepcopy(optim) for _ in range(n_users)]
+    for u in range(n_users):
+        optims[u].reset(omega[u])
+
+    start_time = time.time()
+    active = np.ones(n_users, dtype=bool)
+    n_iters = 0
+    while active.any():
+        if (max_iters is not None and n_iters >= max_iters) or \
+                (time_budget is not None and time.time() - start_time >= time_budget):
+            break
+        omega_old = omega.copy()
 
-        # compute gradient of the log-likelihood
-        e_svf = compute_expected_svf_using_rollouts(task, reward, demo_length)
-        grad = e_features - s_features.T.dot(e_svf)
+        # compute gradient of the log-likelihood of the users that have not converged
+        users = np.flatnonzero(active)
+        reward = np.einsum("usf,uf->us", s_features[users], omega[users])
+        e_svf = compute_expected_svf(task, p_initial[users], reward, demo_length + 1)
+        grad = e_features[users] - np.einsum("usf,us->uf", s_features[users], e_svf)
 
-        # perform optimization step and compute delta for convergence
-        optim.step(grad)
+        for u, user_grad in zip(users, grad):
+            optims[u].step(user_grad)
 
-        # re-compute delta for convergence check
-        delta = np.max(np.abs(omega_old - omega))
-        # print(delta)
+        delta = np.max(np.abs(omega_old - omega), axis=1)
+        active &= delta > eps
+        n_iters += 1
 
-    # re-compute per-state reward and return
-    return s_features.dot(omega), omega
+    return np.einsum("usf,uf->us", s_features, omega), omega
 
 
 # ----------------------------------------- Bayesian inference functions -------------------------------------------- #
@@ -180,6 +361,27 @@ def boltzman_likelihood(state_features, trajectories, weights, rationality=0.99)
     return likelihood, rewards
 
 
+def boltzman_normalizer(state_features, trajectories, weights, rationality=0.99):
+    """
+    Sum of the Boltzmann likelihoods of all trajectories for a weight vector, or for each row of a weight matrix.
+    The trajectories are either enumerated, given as a TrajectoryLattice (see AssemblyTask.get_trajectory_lattice),
+    or streamed as an iterator of chunks (see AssemblyTask.iter_trajectories).
+    """
+    weights = np.atleast_2d(weights)
+    if isinstance(trajectories, TrajectoryLattice):
+        log_z = np.array([trajectories.log_partition(rationality * state_features.dot(w)) for w in weights])
+    else:
+        chunks = trajectories if isinstance(trajectories, Iterator) else [trajectories]
+        log_z = np.full(len(weights), -np.inf)
+        for chunk in chunks:
+            total_rewards = rationality * TrajectoryLattice.feature_sums(state_features, chunk).dot(weights.T)
+            max_reward = total_rewards.max(axis=0)
+            log_z = np.logaddexp(log_z, max_reward + np.log(np.exp(total_rewards - max_reward).sum(axis=0)))
+
+    likelihood = np.exp(log_z)
+    return likelihood if len(likelihood) > 1 else likelihood[0]
+
+
 def get_feature_count(state_features, trajectories):
     feature_counts = []
     for traj in trajectories:
@@ -200,6 +402,7 @@ def random_trajectory(states, demos, transition_function):
 
     demo = demos[0]
     s, available_actions = 0, demo.copy()
+    state_idx = index_states(states)
 
     generated_sequence, score = [], []
     for take_action in demo:
@@ -222,7 +425,7 @@ def random_trajectory(states, demos, transition_function):
 
         generated_sequence.append(take_action)
         p, sp = transition_function(states[s], take_action)
-        s = states.index(sp)
+        s = state_idx[tuple(sp)]
         available_actions.remove(take_action)
 
     return score, generated_sequence
@@ -231,6 +434,7 @@ def random_trajectory(states, demos, transition_function):
 def rollout_trajectory(qf, states, transition_function, remaining_actions, start_state=0):
 
     s = start_state
+    state_idx = index_states(states)
     available_actions = deepcopy(remaining_actions)
     generated_sequence = []
     while len(available_actions) > 0:
@@ -252,7 +456,7 @@ def rollout_trajectory(qf, states, transition_function, remaining_actions, start
         take_action = np.random.choice(candidates)
         generated_sequence.append(take_action)
         p, sp = transition_function(states[s], take_action)
-        s = states.index(sp)
+        s = state_idx[tuple(sp)]
         available_actions.remove(take_action)
 
 
@@ -264,6 +468,7 @@ def predict_trajectory(qf, states, demos, transition_function, sensitivity=0, co
     # assume the same starting state and available actions for all users
     demo = demos[0]  # TODO: for demo in demos:
     s, available_actions = 0, demo.copy()
+    state_idx = index_states(states)
 
     scores, predictions, options = [], [], []
     for take_action in demo:
@@ -296,7 +501,7 @@ def predict_trajectory(qf, states, demos, transition_function, sensitivity=0, co
         scores.append(np.mean(score))
 
         p, sp = transition_function(states[s], take_action)
-        s = states.index(sp)
+        s = state_idx[tuple(sp)]
         available_actions.remove(take_action)
 
     return scores, predictions, options
@@ -306,6 +511,10 @@ def predict_trajectory(qf, states, demos, transition_function, sensitivity=0, co
 
 def online_predict_trajectory(task, demos, task_trajectories, weights, features, samples, priors,
                               sensitivity=0, consider_options=False):
+    """
+    task_trajectories are all trajectories through the task, either enumerated, as a TrajectoryLattice
+    (see AssemblyTask.get_trajectory_lattice) or as an iterator of chunks (see AssemblyTask.iter_trajectories).
+    """
 
     # assume the same starting state and available actions for all users
     demo = demos[0]
@@ -313,19 +522,25 @@ def online_predict_trajectory(task, demos, task_trajectories, weights, features,
     transition_function = task.transition
     states = task.states
 
+    # likelihoods of all task trajectories for each weight sample, computed in a single pass over the trajectories
+    likelihood_all_traj_samples = boltzman_normalizer(features, task_trajectories, np.array(samples))
+
+    # policies for the initial weights and every weight sample the weights can be updated to, in one batched solve
+    all_rewards = features.dot(np.vstack([weights] + list(samples)).T).T
+    q_values, _, _ = batched_value_iteration(task.successors, all_rewards, task.terminal_idx, task.actions)
+    policy_idx = 0
+
     scores, predictions, options = [], [], []
     for step, take_action in enumerate(demo):
 
-        # compute policy for current estimate of weights
-        rewards = features.dot(weights)
-        qf, _, _ = value_iteration(task.states, task.actions, task.transition, rewards, task.terminal_idx)
+        # policy for current estimate of weights
+        qf = q_values[policy_idx]
 
         # anticipate user action in current state
         max_action_val = -np.inf
         candidates, applicants = [], []
         for a in available_actions:
-            p, sp = transition_function(states[s], a)
-            if sp:
+            if task.valid_actions[s, a]:
                 applicants.append(a)
                 if qf[s][a] > (1 + sensitivity) * max_action_val:
                     candidates = [a]
@@ -354,9 +569,8 @@ def online_predict_trajectory(task, demos, task_trajectories, weights, features,
 
             # infer intended user action
             prev_weights = deepcopy(weights)
-            p, sp = transition_function(states[s], take_action)
             future_actions.remove(take_action)
-            ro = rollout_trajectory(qf, states, transition_function, future_actions, states.index(sp))
+            ro = rollout_trajectory(qf, states, transition_function, future_actions, task.successors[s, take_action])
             future_actions.append(take_action)
             complex_user_demo = [demo[:step] + [take_action] + ro]
             complex_trajectories = get_trajectories(states, complex_user_demo, transition_function)
@@ -376,9 +590,9 @@ def online_predict_trajectory(task, demos, task_trajectories, weights, features,
             for n_sample in range(n_samples):
                 weight_idx = np.random.choice(range(len(samples)), size=1, p=weight_priors)[0]
                 complex_weights = samples[weight_idx]
-                likelihood_all_traj, _ = boltzman_likelihood(features, task_trajectories, complex_weights)
+                likelihood_all_traj = np.atleast_1d(likelihood_all_traj_samples)[weight_idx]
                 likelihood_user_demo, r = boltzman_likelihood(features, complex_trajectories, complex_weights)
-                likelihood_user_demo = likelihood_user_demo / np.sum(likelihood_all_traj)
+                likelihood_user_demo = likelihood_user_demo / likelihood_all_traj
                 bayesian_update = (likelihood_user_demo[0] * weight_priors[n_sample])
 
                 # new_samples.append(complex_weights)
@@ -387,15 +601,15 @@ def online_predict_trajectory(task, demos, task_trajectories, weights, features,
             posterior = list(posterior / np.sum(posterior))
             max_posterior = max(posterior)
 
-            weights = samples[posterior.index(max_posterior)]
+            policy_idx = 1 + posterior.index(max_posterior)
+            weights = samples[policy_idx - 1]
             # samples = deepcopy(new_samples)
             # priors = deepcopy(posterior)
 
             print("Updated weights from", prev_weights, "to", weights)
 
         # priors = priors / np.sum(priors)
-        p, sp = transition_function(states[s], take_action)
-        s = states.index(sp)
+        s = task.successors[s, take_action]
         available_actions.remove(take_action)
 
     return scores, predictions, options
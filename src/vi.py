@@ -1,66 +1,166 @@
 import numpy as np
 
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    # the sparse backend is optional
+    sparse = None
 
-def value_iteration(states, actions, transition, rewards, terminal_states, delta=1e-3):
+# tasks with at least this many states are solved with the sparse backend (if scipy is installed)
+SPARSE_MIN_STATES = 50000
+
+
+def value_iteration(states, actions, transition, rewards, terminal_states, delta=1e-3, method="sweep",
+                    init_qf=None, init_vf=None, start_state=None, backend="auto"):
     """
     Perform value iteration to calculate converged values for each state
     Args:
         states: list of all states
         actions: list of all actions
-        transition: function that takes in current state and action, and return the next state and probability
+        transition: function that takes in current state and action, and return the next state and probability,
+                    or a precompiled (n_states, n_actions) table of next state indices (-1 if action is not allowed)
         terminal_states: index of terminal states
         rewards: list of rewards for each state
         delta: error threshold
+        method: "sweep" to iterate Bellman backups until convergence, or "backward" to solve the acyclic
+                task exactly in one backward pass (see backward_induction)
+        init_qf: q-values from a previous solve (dict or (n_states, n_actions) array), kept for the states that
+                 are not re-solved
+        init_vf: values from a previous solve (dict or array), used as initial guess of the sweeps
+        start_state: index of the current state, only the states reachable from it are re-solved
+        backend: "dense", "sparse" (only legal transitions are stored, always solved by backward induction)
+                 or "auto" to use the sparse backend for large tasks (see use_sparse)
 
     Returns: q-value for each state-action pair, value for each state, optimal actions in each state
 
     """
-    vf = {s: 0 for s in range(len(states))}  # values
-    op_actions = {s: 0 for s in range(len(states))}  # optimal actions
+    if callable(transition):
+        # evaluate the transition function once for each state-action pair instead of in every sweep
+        state_idx = {tuple(s): idx for idx, s in enumerate(states)}
+        successors = -np.ones((len(states), max(actions) + 1), dtype=np.int32)
+        for j_state, state in enumerate(states):
+            for k_action in actions:
+                prob_ns, ns = transition(state, k_action)
+                if ns:
+                    successors[j_state, k_action] = state_idx[tuple(ns)]
+    else:
+        successors = transition
 
-    qf = {s: {a: 0 for a in actions} for s in range(len(states))}
+    successors = np.asarray(successors)
+    rewards = np.asarray(rewards, dtype=np.float64)
+    n_states = len(successors)
 
-    for i in range(100):
-        vf_temp = {s: 0 for s in range(len(states))}
+    q_values = np.zeros((n_states, len(actions))) if init_qf is None else _q_array(init_qf, n_states, actions)
+    values = np.zeros(n_states) if init_vf is None else _v_array(init_vf, n_states)
+    op_actions = np.zeros(n_states, dtype=int)
 
-        for j_state in vf:
-            max_action = -1
-            max_action_val = -np.inf
+    if start_state is None:
+        solved = np.arange(n_states)
+        sub_successors, sub_terminal = successors, terminal_states
+    else:
+        # only re-solve the states that can still be reached from the current state
+        solved = reachable_states(successors[:, list(actions)], start_state)
+        sub_idx = -np.ones(n_states + 1, dtype=int)  # last entry maps -1 (action not allowed) to itself
+        sub_idx[solved] = np.arange(len(solved))
+        sub_successors = sub_idx[successors[solved]]
+        sub_terminal = sub_idx[list(terminal_states)]
+        sub_terminal = sub_terminal[sub_terminal >= 0]
 
-            # Check if terminal state
-            if j_state in terminal_states:
-                vf_temp[j_state] = rewards[j_state]
-                # qf[j_state][k_action] = 1
-                continue
+    if use_sparse(sub_successors, backend):
+        sub_q, sub_v, sub_op = sparse_backward_induction(TransitionEdges(sub_successors, actions), rewards[solved],
+                                                         sub_terminal)
+    elif method == "backward":
+        sub_q, sub_v, sub_op = backward_induction(sub_successors, rewards[solved], sub_terminal, actions)
+    elif method == "sweep":
+        sub_q, sub_v, sub_op = vectorized_value_iteration(sub_successors, rewards[solved], sub_terminal, actions,
+                                                          delta, initial_values=values[solved])
+    else:
+        raise ValueError("Unknown value iteration method: %s" % method)
+    q_values[solved], values[solved], op_actions[solved] = sub_q, sub_v, sub_op
 
-            for k_action in actions:
-                prob_ns, ns = transition(states[j_state], k_action)
-                qf[j_state][k_action] = rewards[j_state]
-                if ns:
-                    int_ns = states.index(ns)
-                    qf[j_state][k_action] += prob_ns * vf[int(int_ns)]
-
-                # Select max value v = max_a q(s, a)
-                if qf[j_state][k_action] > max_action_val:
-                    max_action = k_action
-                    max_action_val = qf[j_state][k_action]
-
-            # Update the value of the state
-            vf_temp[j_state] = max_action_val
-
-            # Simultaneously store the best action for the state
-            op_actions[j_state] = max_action
-
-        # After iterating over all states check if values have converged
-        np_v = []
-        np_v_temp = []
-        for s in vf:
-            np_v.append(vf[s])
-            np_v_temp.append(vf_temp[s])
-        np_v = np.array(np_v)
-        np_v_temp = np.array(np_v_temp)
-        change = np.linalg.norm((np_v - np_v_temp))
-        vf = vf_temp
+    return to_dict_values(q_values, values, op_actions, actions)
+
+
+def reachable_states(successors, start_state):
+    """
+    Find the states that can be reached from a state
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        start_state: index of the state to start from
+
+    Returns: sorted indices of the reachable states (including the start state)
+
+    """
+    successors = np.asarray(successors)
+    reachable = np.zeros(len(successors), dtype=bool)
+    reachable[start_state] = True
+    frontier = np.array([start_state])
+    while len(frontier) > 0:
+        next_states = successors[frontier].ravel()
+        next_states = np.unique(next_states[next_states >= 0])
+        frontier = next_states[~reachable[next_states]]
+        reachable[frontier] = True
+
+    return np.flatnonzero(reachable)
+
+
+def _q_array(qf, n_states, actions):
+    if isinstance(qf, dict):
+        return np.array([[qf[s].get(a, 0.0) for a in actions] for s in range(n_states)], dtype=np.float64)
+    return np.array(qf, dtype=np.float64)[:, list(actions)]
+
+
+def _v_array(vf, n_states):
+    if isinstance(vf, dict):
+        return np.array([vf[s] for s in range(n_states)], dtype=np.float64)
+    return np.array(vf, dtype=np.float64)
+
+
+def vectorized_value_iteration(successors, rewards, terminal_states, actions=None, delta=1e-3, max_iters=100,
+                               initial_values=None):
+    """
+    Perform value iteration with array operations over a successor table
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        rewards: reward of each state, or a (K, n_states) matrix of rewards to solve K tasks at once
+        terminal_states: index of terminal states
+        actions: actions (columns of the successor table) to consider, all actions if None
+        delta: error threshold
+        max_iters: maximum number of sweeps
+        initial_values: initial guess of the value of each state (e.g. from a previous solve), zero if None
+
+    Returns: q-values (n_states, len(actions)), values (n_states,) and index of the optimal action in each state,
+             with a leading K dimension for a matrix of rewards
+
+    """
+    successors = np.asarray(successors)
+    if actions is None:
+        actions = range(successors.shape[1])
+    successors = successors[:, list(actions)]
+    rewards = np.asarray(rewards, dtype=np.float64)
+    n_states, n_actions = successors.shape
+
+    terminal = np.zeros(n_states, dtype=bool)
+    terminal[list(terminal_states)] = True
+    valid = successors >= 0
+    next_states = np.where(valid, successors, 0)
+
+    values = np.zeros(rewards.shape) if initial_values is None else np.broadcast_to(initial_values, rewards.shape)
+    q_values = np.zeros(rewards.shape + (n_actions,))
+    op_actions = np.zeros(rewards.shape, dtype=int)
+    if n_actions == 0:
+        return q_values, np.where(terminal, rewards, -np.inf), op_actions
+
+    for i in range(max_iters):
+        # Bellman backup of all non-terminal state-action pairs at once
+        q_values = np.where(valid, rewards[..., None] + values[..., next_states], rewards[..., None])
+        q_values[..., terminal, :] = 0
+
+        op_actions = np.where(terminal, 0, np.argmax(q_values, axis=-1))
+        values_temp = np.where(terminal, rewards, q_values.max(axis=-1))
+
+        change = np.linalg.norm(values - values_temp)
+        values = values_temp
         if change < delta:
             # print("VI converged after %d iterations" % (i))
             break
@@ -68,4 +168,335 @@ def value_iteration(states, actions, transition, rewards, terminal_states, delta
     if change >= delta:
         print("VI did not converge after %d iterations (delta=%.2f)" % (i, change))
 
+    return q_values, values, op_actions
+
+
+def batched_value_iteration(successors, rewards, terminal_states, actions=None, method="backward", delta=1e-3):
+    """
+    Compute the q-values of a task for many reward vectors (e.g. weight hypotheses) in one vectorized solve
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        rewards: (K, n_states) matrix with the reward of each state for each of the K reward vectors
+        terminal_states: index of terminal states
+        actions: actions (columns of the successor table) to consider, all actions if None
+        method: "backward" for backward_induction or "sweep" for vectorized_value_iteration
+        delta: error threshold of the sweeps
+
+    Returns: q-values (K, n_states, len(actions)), values (K, n_states) and index of the optimal actions (K, n_states)
+
+    """
+    rewards = np.atleast_2d(np.asarray(rewards, dtype=np.float64))
+    if method == "backward":
+        return backward_induction(successors, rewards, terminal_states, actions)
+    elif method == "sweep":
+        return vectorized_value_iteration(successors, rewards, terminal_states, actions, delta)
+    else:
+        raise ValueError("Unknown value iteration method: %s" % method)
+
+
+def topological_levels(successors, terminal_states=()):
+    """
+    Order the states of an acyclic task so that every next state comes before the state it is reached from
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        terminal_states: index of terminal states (their actions are ignored)
+
+    Returns: length of the longest path from each state to a state without next states
+
+    """
+    successors = np.asarray(successors)
+    n_states = len(successors)
+    valid = successors >= 0
+    valid[list(terminal_states)] = False
+    has_next = valid.any(axis=1)
+    next_states = np.where(valid, successors, 0)
+
+    heights = np.zeros(n_states, dtype=int)
+    for _ in range(n_states + 1):
+        heights_temp = np.where(has_next, 1 + np.where(valid, heights[next_states], -1).max(axis=1, initial=-1), 0)
+        if np.array_equal(heights, heights_temp):
+            return heights
+        heights = heights_temp
+
+    raise ValueError("The state graph is not acyclic")
+
+
+def backward_induction(successors, rewards, terminal_states, actions=None, levels=None):
+    """
+    Compute exact values of an acyclic (assembly) task in a single backward pass over its states
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        rewards: reward of each state, or a (K, n_states) matrix of rewards to solve K tasks at once
+        terminal_states: index of terminal states
+        actions: actions (columns of the successor table) to consider, all actions if None
+        levels: number of completed actions in each state, the states are then solved from the last level to
+                the first (every action completes one more action), computed from the successor table if None
+
+    Returns: q-values (n_states, len(actions)), values (n_states,) and index of the optimal action in each state,
+             with a leading K dimension for a matrix of rewards
+
+    """
+    successors = np.asarray(successors)
+    if actions is None:
+        actions = range(successors.shape[1])
+    successors = successors[:, list(actions)]
+    rewards = np.asarray(rewards, dtype=np.float64)
+    n_states, n_actions = successors.shape
+
+    terminal = np.zeros(n_states, dtype=bool)
+    terminal[list(terminal_states)] = True
+    valid = successors >= 0
+    next_states = np.where(valid, successors, 0)
+
+    if levels is None:
+        # solve states in order of increasing distance to the end of the task
+        order = -topological_levels(successors, terminal_states)
+    else:
+        order = np.asarray(levels)
+
+    values = np.array(rewards)
+    q_values = np.zeros(rewards.shape + (n_actions,))
+    op_actions = np.zeros(rewards.shape, dtype=int)
+    if n_actions == 0:
+        return q_values, np.where(terminal, rewards, -np.inf), op_actions
+
+    for level in np.unique(order)[::-1]:
+        level_states = np.flatnonzero((order == level) & ~terminal)
+        q = np.where(valid[level_states], rewards[..., level_states, None] + values[..., next_states[level_states]],
+                     rewards[..., level_states, None])
+        q_values[..., level_states, :] = q
+        op_actions[..., level_states] = np.argmax(q, axis=-1)
+        values[..., level_states] = q.max(axis=-1)
+
+    return q_values, values, op_actions
+
+
+def soft_value_iteration(successors, rewards, terminal_states, actions=None, levels=None):
+    """
+    Compute soft (maximum entropy) values of an acyclic task in log space, in a single backward pass over its states
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        rewards: reward of each state, or a (K, n_states) matrix of rewards to solve K tasks at once
+        terminal_states: index of terminal states (their soft value is 0)
+        actions: actions (columns of the successor table) to consider, all actions if None
+        levels: number of completed actions in each state, computed from the successor table if None
+
+    Returns: soft q-values (n_states, len(actions)) with -inf for actions that are not allowed, soft values
+             (n_states,) and the stochastic policy (n_states, len(actions)) exp(q - v), with a leading K dimension
+             for a matrix of rewards
+
+    """
+    successors = np.asarray(successors)
+    if actions is None:
+        actions = range(successors.shape[1])
+    successors = successors[:, list(actions)]
+    rewards = np.asarray(rewards, dtype=np.float64)
+    n_states, n_actions = successors.shape
+
+    terminal = np.zeros(n_states, dtype=bool)
+    terminal[list(terminal_states)] = True
+    valid = successors >= 0
+    next_states = np.where(valid, successors, 0)
+
+    if levels is None:
+        order = -topological_levels(successors, terminal_states)
+    else:
+        order = np.asarray(levels)
+
+    values = np.where(terminal, 0.0, -np.inf) * np.ones(rewards.shape)
+    q_values = np.full(rewards.shape + (n_actions,), -np.inf)
+    for level in np.unique(order)[::-1]:
+        level_states = np.flatnonzero((order == level) & ~terminal)
+        q = np.where(valid[level_states], rewards[..., level_states, None] + values[..., next_states[level_states]],
+                     -np.inf)
+        q_values[..., level_states, :] = q
+
+        # log-sum-exp over the actions, shifted by the largest q-value to avoid overflow
+        q_max = q.max(axis=-1, initial=-np.inf)
+        q_shift = np.where(np.isfinite(q_max), q_max, 0.0)
+        with np.errstate(divide="ignore"):
+            values[..., level_states] = np.log(np.exp(q - q_shift[..., None]).sum(axis=-1)) + q_shift
+
+    with np.errstate(invalid="ignore"):
+        policy = np.nan_to_num(np.exp(q_values - values[..., None]))
+    policy[..., terminal, :] = 0.0
+
+    return q_values, values, policy
+
+
+def use_sparse(successors, backend="auto"):
+    """
+    Select the backend for solving a task
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        backend: "dense", "sparse" or "auto" to use the sparse backend for tasks with at least SPARSE_MIN_STATES
+                 states when scipy is installed
+
+    Returns: True if the sparse backend is used
+
+    """
+    if backend == "auto":
+        return sparse is not None and len(successors) >= SPARSE_MIN_STATES
+    elif backend == "sparse":
+        if sparse is None:
+            raise ImportError("scipy is required for the sparse backend")
+        return True
+    elif backend == "dense":
+        return False
+    else:
+        raise ValueError("Unknown backend: %s" % backend)
+
+
+class TransitionEdges:
+    """
+    Legal transitions of a task as an edge list sorted by state, i.e. the successor table in CSR format
+    Args:
+        successors: (n_states, n_actions) table of next state indices (-1 if action is not allowed)
+        actions: actions (columns of the successor table) to consider, all actions if None
+
+    Attributes:
+        states, actions, next_states: state, index of the action and next state of each transition
+        indptr: transitions of state s are indptr[s]:indptr[s + 1]
+    """
+    def __init__(self, successors, actions=None):
+        successors = np.asarray(successors)
+        if actions is not None:
+            successors = successors[:, list(actions)]
+        self.n_states, self.n_actions = successors.shape
+
+        self.states, self.actions = np.nonzero(successors >= 0)
+        self.next_states = successors[self.states, self.actions]
+        self.indptr = np.zeros(self.n_states + 1, dtype=int)
+        np.cumsum(np.bincount(self.states, minlength=self.n_states), out=self.indptr[1:])
+
+    def matrix(self, weights=None, transpose=False):
+        """
+        Sparse (n_states, n_states) matrix with the weight of each transition (e.g. action probabilities)
+        """
+        if weights is None:
+            weights = np.ones(len(self.states))
+        rows, cols = (self.next_states, self.states) if transpose else (self.states, self.next_states)
+        return sparse.csr_matrix((weights, (rows, cols)), shape=(self.n_states, self.n_states))
+
+    def levels(self, terminal_states=()):
+        """
+        Same as topological_levels, computed over the edge list
+        """
+        keep = ~np.isin(self.states, list(terminal_states))
+        states, next_states = self.states[keep], self.next_states[keep]
+
+        heights = np.zeros(self.n_states, dtype=int)
+        for _ in range(self.n_states + 1):
+            heights_temp = np.zeros(self.n_states, dtype=int)
+            np.maximum.at(heights_temp, states, 1 + heights[next_states])
+            if np.array_equal(heights, heights_temp):
+                return heights
+            heights = heights_temp
+
+        raise ValueError("The state graph is not acyclic")
+
+
+def _sparse_backward_pass(edges, rewards, terminal_states, levels, soft):
+    # values of the states and q-values of the transitions, solved level by level over the edge list
+    terminal = np.zeros(edges.n_states, dtype=bool)
+    terminal[list(terminal_states)] = True
+    order = -edges.levels(terminal_states) if levels is None else np.asarray(levels)
+
+    values = np.where(terminal, 0.0, -np.inf) if soft else np.array(rewards)
+    q_edges = np.zeros(len(edges.states))
+
+    keep = np.flatnonzero(~terminal[edges.states])
+    edge_order = order[edges.states[keep]]
+    keep = keep[np.argsort(-edge_order, kind="stable")]  # transitions of each state remain contiguous
+    bounds = np.flatnonzero(np.diff(-np.sort(-edge_order))) + 1
+    for level_edges in np.split(keep, bounds):
+        if len(level_edges) == 0:
+            continue
+        states = edges.states[level_edges]
+        q = rewards[states] + values[edges.next_states[level_edges]]
+        q_edges[level_edges] = q
+
+        starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]])
+        q_max = np.maximum.reduceat(q, starts)
+        if soft:
+            # log-sum-exp over the transitions of each state, shifted by the largest q-value
+            q_shift = np.where(np.isfinite(q_max), q_max, 0.0)
+            with np.errstate(divide="ignore"):
+                group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(q)]))
+                values[states[starts]] = np.log(np.add.reduceat(np.exp(q - q_shift[group]), starts)) + q_shift
+        else:
+            # as in the dense solvers, actions that are not allowed have q-value = reward
+            blocked = np.diff(edges.indptr)[states[starts]] < edges.n_actions
+            values[states[starts]] = np.where(blocked, np.maximum(q_max, rewards[states[starts]]), q_max)
+
+    return values, q_edges, keep
+
+
+def sparse_backward_induction(edges, rewards, terminal_states, levels=None):
+    """
+    Same as backward_induction, with only the legal transitions stored (see TransitionEdges)
+    Args:
+        edges: TransitionEdges of the task
+        rewards: reward of each state
+        terminal_states: index of terminal states
+        levels: number of completed actions in each state, computed from the edge list if None
+
+    Returns: q-values (n_states, n_actions), values (n_states,) and index of the optimal action in each state
+
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    values, q_edges, solved = _sparse_backward_pass(edges, rewards, terminal_states, levels, soft=False)
+
+    q_values = np.repeat(rewards[:, None], edges.n_actions, axis=1)
+    q_values[terminal_states] = 0
+    q_values[edges.states[solved], edges.actions[solved]] = q_edges[solved]
+    op_actions = np.argmax(q_values, axis=1)
+    op_actions[terminal_states] = 0
+
+    return q_values, values, op_actions
+
+
+def sparse_soft_value_iteration(edges, rewards, terminal_states, levels=None):
+    """
+    Same as soft_value_iteration, with only the legal transitions stored (see TransitionEdges)
+    Args:
+        edges: TransitionEdges of the task
+        rewards: reward of each state
+        terminal_states: index of terminal states (their soft value is 0)
+        levels: number of completed actions in each state, computed from the edge list if None
+
+    Returns: soft q-value (-inf from terminal states), soft values (n_states,) and probability of each transition
+             in the order of the edge list
+
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    values, q_edges, solved = _sparse_backward_pass(edges, rewards, terminal_states, levels, soft=True)
+
+    policy = np.zeros(len(q_edges))
+    with np.errstate(invalid="ignore"):
+        policy[solved] = np.nan_to_num(np.exp(q_edges[solved] - values[edges.states[solved]]))
+    unsolved = np.ones(len(q_edges), dtype=bool)
+    unsolved[solved] = False
+    q_edges[unsolved] = -np.inf
+
+    return q_edges, values, policy
+
+
+def to_dict_values(q_values, values, op_actions, actions):
+    """
+    Convert the arrays returned by vectorized_value_iteration to the dictionaries returned by value_iteration
+    Args:
+        q_values: (n_states, len(actions)) array of q-values
+        values: (n_states,) array of values
+        op_actions: index of the optimal action in each state
+        actions: list of actions
+
+    Returns: q-value for each state-action pair, value for each state, optimal actions in each state
+
+    """
+    actions = list(actions)
+    qf = {s: dict(zip(actions, q_s)) for s, q_s in enumerate(np.asarray(q_values).tolist())}
+    vf = dict(enumerate(np.asarray(values).tolist()))
+    op_actions = {s: actions[a] if actions else 0 for s, a in enumerate(np.asarray(op_actions).tolist())}
+
     return qf, vf, op_actions
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import pdb
 import sys
 import time
@@ -23,6 +24,7 @@ from src.vi import value_iteration
 import src.optimizer as O  # stochastic gradient descent optimizer
 from src.maxent_irl import *
 from src.assembly_tasks import *
+from src.compiled_mdp import load_mdp, load_q_table
 from src.import_qualtrics import get_qualtrics_survey
 
 
@@ -211,15 +213,30 @@ class AssemblyController(QMainWindow):
 
         user_id = input("Enter user id: ")
 
-        # load the learned q_values for each state
-        self.qf = pickle.load(open(directory_syspath + "/data/q_values_" + user_id + ".p", "rb"))
-        self.states = pickle.load(open(directory_syspath + "/data/states_" + user_id + ".p", "rb"))
+        mdp_path = directory_syspath + "/data/mdp_" + user_id + ".mdp"
+        if os.path.exists(mdp_path):
+            # memory map the compiled task, learned q_values and variables for computing weights
+            self.task = load_mdp(mdp_path)
+            self.qf = self.task.q_values
+            self.states = self.task.states.tolist()
+            self.weights = np.array(self.task.metadata["weights"])
+            self.features = np.array(self.task.state_features)
+        else:
+            # load the learned q_values for each state
+            q_table_path = directory_syspath + "/data/q_values_" + user_id + ".qtable"
+            if os.path.exists(q_table_path):
+                self.qf = load_q_table(q_table_path)
+                self.states = self.qf.states
+            else:
+                self.qf = pickle.load(open(directory_syspath + "/data/q_values_" + user_id + ".p", "rb"))
+                self.states = pickle.load(open(directory_syspath + "/data/states_" + user_id + ".p", "rb"))
 
-        ###
-        # load the variables for computing weights
-        self.weights = np.array(pickle.load(open(directory_syspath + "/data/weights_" + user_id + ".p", "rb")))
-        self.features = np.array(pickle.load(open(directory_syspath + "/data/features_" + user_id + ".p", "rb")))
-        self.task = pickle.load(open(directory_syspath + "/data/task_" + user_id + ".p", "rb"))
+            ###
+            # load the variables for computing weights
+            self.weights = np.array(pickle.load(open(directory_syspath + "/data/weights_" + user_id + ".p", "rb")))
+            self.features = np.array(pickle.load(open(directory_syspath + "/data/features_" + user_id + ".p", "rb")))
+            self.task = pickle.load(open(directory_syspath + "/data/task_" + user_id + ".p", "rb"))
+        self.state_idx = index_states(self.states)
 
         # actions in airplane assembly and objects required for each action
         self.all_user_actions = [0, 1, 2, 2, 2, 2, 3, 4, 4, 4, 4, 5, 6, 6, 6, 6, 7]
@@ -454,8 +471,8 @@ class AssemblyController(QMainWindow):
         max_action_val = -np.inf
         available_actions, anticipated_actions = [], []
         
+        s_idx = self.state_idx[tuple(current_state)]
         for a in remaining_user_actions:
-            s_idx = self.states.index(current_state)
             p, next_state = common.transition(current_state, a)
             
             # check if the action results in a new state
@@ -515,7 +532,7 @@ class AssemblyController(QMainWindow):
 
                 future_actions = deepcopy(self.remaining_user_actions)
                 future_actions.remove(new_a)
-                ro = rollout_trajectory(self.qf, self.states, common.transition, future_actions, self.states.index(sp))
+                ro = rollout_trajectory(self.qf, self.states, common.transition, future_actions, self.state_idx[tuple(sp)])
                 future_actions.append(new_a)
                 complex_user_demo = [detected_sequence[:self.time_step + count] + [new_a] + ro]
                 complex_trajectories = get_trajectories(self.states, complex_user_demo, common.transition)
@@ -543,13 +560,16 @@ class AssemblyController(QMainWindow):
 
                 # Max entropy approach
                 print(len(self.states),len(self.task.states))
-                _, new_weights = maxent_irl(self.task, self.features, complex_trajectories, self.optim, self.init)
+                _, new_weights = maxent_irl(self.task, self.features, complex_trajectories, self.optim, self.init,
+                                            max_iters=500)
                 self.weights = new_weights
 
 
-                # compute new q values from new weights
+                # compute new q values from new weights, only for the states that can still be reached
                 rewards = self.features.dot(self.weights)
-                self.qf, _, _ = value_iteration(self.states, self.remaining_user_actions, self.task.transition, rewards, self.task.terminal_idx)
+                self.qf, _, _ = value_iteration(self.states, self.remaining_user_actions, self.task.successors, rewards,
+                                             self.task.terminal_idx, method="backward", init_qf=self.qf,
+                                             start_state=self.state_idx[tuple(current_state)])
                 
                 weights_updated = not np.array_equal(prev_weights, self.weights)
                 print("Are weights updated", weights_updated)